@@ -7,38 +7,693 @@ import math
 from pathlib import Path
 from PyQt5.QtCore import (QObject, pyqtProperty, pyqtSignal, Qt,
     QRect, QPoint, QSize, QThread, QMutex, QWaitCondition, QMutexLocker,
-    QBuffer, QPointF)
+    QBuffer, QPointF, QRectF, QRunnable, QThreadPool, QTimer, QT_VERSION_STR)
 from PyQt5.QtWidgets import (QWidget, QPushButton, QToolBar,
     QHBoxLayout, QVBoxLayout, QApplication, QMainWindow, QAction,
-    QCheckBox, QRadioButton, QButtonGroup)
+    QCheckBox, QRadioButton, QButtonGroup, QComboBox, QSpinBox, QLabel,
+    QProgressBar)
 from PyQt5.QtGui import (QPixmap, QImage, QImageReader,
     QPainter, QBrush, QIcon, QColor,
-    QTransform)
-
-import cv2
-import numpy as np
+    QTransform, QGuiApplication, QFontDatabase)
 
 import os
-import shutil
 import threading
+import socket
+import time
+import argparse
+import json
+import struct
+import hashlib
+import gzip
+import multiprocessing
+import platform
+import statistics
+import tempfile
+import contextlib
+import bisect
+import queue
+import re
+import importlib
+from collections import deque
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from http.server import (ThreadingHTTPServer, BaseHTTPRequestHandler)
+from urllib.parse import urlsplit, parse_qs
+
+
+class LazyModule:
+    # imports the module on first use, opencv and numpy take most of the
+    # start time and are not needed to show the editor
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module == None:
+            start = time.perf_counter()
+            self._module = importlib.import_module(self._name)
+            print("imported %s in %.0f ms" % (self._name,
+                1000*(time.perf_counter()-start)))
+        return getattr(self._module, attr)
+
+
+cv2 = LazyModule("cv2")
+np = LazyModule("numpy")
+
+
+def readImage(path, maxSize=0):
+    # decode with exif orientation, optionally scaled down to fit maxSize
+    p = QImageReader(path)
+    if not p.canRead(): return None
+    p.setAutoTransform(True)
+    if maxSize > 0 and max(p.size().width(), p.size().height()) > maxSize:
+        p.setScaledSize(p.size().scaled(maxSize, maxSize, Qt.KeepAspectRatio))
+    img = p.read()
+    if img.isNull(): return None
+    # 4 bytes per pixel so that the pixels can be used with numpy as well
+    if img.hasAlphaChannel():
+        return img.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+    return img.convertToFormat(QImage.Format_RGB32)
+
+
+def fileHash(path):
+    # content hash of a file, identifies images independent of their name
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20), b""): h.update(chunk)
+    return h.hexdigest()
+
+
+class DiskCache:
+    # decoded proxies or depth maps, stored as numpy files named after a
+    # hash of everything they were computed from. Reading a file touches
+    # it, so the least recently used files are deleted first.
+    maxBytes = 512<<20
+
+    def __init__(self, path=None, maxBytes=None):
+        if path == None:
+            base = os.environ.get("XDG_CACHE_HOME") or Path.home().joinpath(".cache")
+            path = Path(base).joinpath("3dmacher")
+        self.path = Path(path)
+        if maxBytes != None: self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self._bytes = None
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha1(json.dumps(parts).encode()).hexdigest()
+
+    def _file(self, key):
+        return self.path.joinpath(key+".npz")
+
+    def get(self, key):
+        f = self._file(key)
+        try:
+            with np.load(f) as data:
+                arrays = dict(data)
+            os.utime(f)
+            return arrays
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            # empty or truncated files would fail every time, start over
+            print("dropping unreadable cache "+str(f)+": "+repr(e))
+            try:
+                f.unlink()
+            except OSError:
+                pass
+            return None
+
+    def put(self, key, compressed=False, **arrays):
+        # write under a private name first, readers never see partial files
+        f = self._file(key)
+        tmp = f.with_name(key+"."+str(threading.get_ident())+".tmp")
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            with open(tmp, 'wb') as out:
+                (np.savez_compressed if compressed else np.savez)(out, **arrays)
+            os.replace(tmp, f)
+        except OSError as e:
+            print("cannot write cache "+str(f)+": "+str(e))
+            return
+        with self.lock:
+            st = self._stat(f)
+            if self._bytes != None and st != None: self._bytes += st.st_size
+            self.evict()
+
+    @staticmethod
+    def _stat(f):
+        # other instances share the directory and may delete files anytime
+        try:
+            return f.stat()
+        except OSError:
+            return None
+
+    def evict(self):
+        if self._bytes != None and self._bytes <= self.maxBytes: return
+        files = [(self._stat(f), f) for f in self.path.glob("*.npz")]
+        files = [(st, f) for st, f in files if st != None]
+        self._bytes = sum(st.st_size for st, f in files)
+        for st, f in sorted(files, key=lambda e: e[0].st_mtime):
+            if self._bytes <= self.maxBytes: break
+            try:
+                f.unlink()
+            except OSError:
+                continue
+            self._bytes -= st.st_size
+
+    def getImage(self, key):
+        data = self.get(key)
+        if data == None: return None
+        pixels = data["pixels"]
+        img = QImage(pixels.shape[1], pixels.shape[0], QImage.Format(int(data["format"])))
+        np.copyto(imageArray(img, True), pixels)
+        return img
+
+    def putImage(self, key, img):
+        self.put(key, pixels=imageArray(img), format=np.array(int(img.format())))
+
+
+_diskCache = None
+_depthCache = None
+
+def diskCache():
+    # shared by all threads of the process
+    global _diskCache
+    if _diskCache == None: _diskCache = DiskCache()
+    return _diskCache
+
+
+def depthCache():
+    # depth maps are written after every pause while aligning and rarely
+    # read again, their own budget keeps them from evicting the proxies
+    global _depthCache
+    if _depthCache == None:
+        _depthCache = DiskCache(diskCache().path.joinpath("depth"), 64<<20)
+    return _depthCache
+
+
+class Histogram:
+    # upper bounds of the buckets in seconds, the last bucket is unbounded
+    bounds = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+
+    def __init__(self):
+        self.buckets = [0]*(len(self.bounds)+1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def add(self, seconds):
+        self.buckets[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.last = seconds
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-quantile
+        rank = q*self.count
+        seen = 0
+        for bound, n in zip(self.bounds, self.buckets):
+            seen += n
+            if seen >= rank: return bound
+        return self.max
+
+    def asDict(self):
+        return dict(count=self.count, total=self.total, max=self.max,
+            last=self.last, bounds=list(self.bounds), buckets=list(self.buckets))
+
+
+class Metrics:
+    # durations of the hot paths, counters and gauges, written from all
+    # threads and shown in the overlay and on /metrics
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter()-start)
+
+    def record(self, stage, seconds):
+        with self.lock:
+            if stage not in self.stages: self.stages[stage] = Histogram()
+            self.stages[stage].add(seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0)+n
+
+    def gauge(self, name, delta):
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0)+delta
+
+    def asDict(self):
+        with self.lock:
+            return dict(
+                stages=dict((k, h.asDict()) for k, h in self.stages.items()),
+                counters=dict(self.counters), gauges=dict(self.gauges))
+
+    def summary(self, prefixes):
+        # one line per stage, counter and gauge starting with a prefix
+        match = lambda name: name.split(".")[0] in prefixes
+        lines = []
+        with self.lock:
+            for name, h in sorted(self.stages.items()):
+                if not match(name): continue
+                lines.append("%-16s %6d  %7.1f ms  p90 %6.0f ms" % (name,
+                    h.count, h.last*1000, h.quantile(0.9)*1000))
+            for name, n in sorted(list(self.counters.items())+list(self.gauges.items())):
+                if match(name): lines.append("%-16s %6d" % (name, n))
+        return lines
+
+
+metrics = Metrics()
+
+
+def paintMetrics(qp, rect, lines):
+    # text on a dark box in the top left corner of rect
+    if not lines: return
+    qp.save()
+    font = QFontDatabase.systemFont(QFontDatabase.FixedFont)
+    qp.setFont(font)
+    fm = qp.fontMetrics()
+    box = QRect(rect.x(), rect.y(),
+        max(fm.horizontalAdvance(l) for l in lines)+8,
+        fm.height()*len(lines)+8)
+    qp.fillRect(box, QColor(0,0,0,180))
+    qp.setPen(QColor(255,255,255))
+    for i, line in enumerate(lines):
+        qp.drawText(box.x()+4, box.y()+4+fm.ascent()+i*fm.height(), line)
+    qp.restore()
+
+
+def transformToList(t):
+    return [t.m11(), t.m12(), t.m13(), t.m21(), t.m22(), t.m23(),
+        t.m31(), t.m32(), t.m33()]
+
+
+def transformFromList(values):
+    return QTransform(*values)
+
+
+def buildLevels(image, minSize=256):
+    # proxy pyramid, every level has half the size of the previous one
+    levels = [image]
+    while min(levels[-1].width(), levels[-1].height()) >= 2*minSize:
+        levels.append(levels[-1].scaled(levels[-1].width()//2,
+            levels[-1].height()//2, Qt.IgnoreAspectRatio,
+            Qt.SmoothTransformation))
+    return levels
+
+
+def pickLevel(levels, width, rotation=0):
+    # smallest proxy that is at least width pixels wide once rotated by
+    # rotation quarter turns
+    for img in reversed(levels):
+        if orientedSize(img, rotation).width() >= width: return img
+    return levels[0]
+
+
+def orientedSize(img, rotation):
+    if rotation % 2: return QSize(img.height(), img.width())
+    return img.size()
+
+
+def rotationMatrix(rotation):
+    # QTransform().rotate(90*rotation) as 2x2 matrix
+    c, s = [(1, 0), (0, 1), (-1, 0), (0, -1)][rotation % 4]
+    return np.array([[c, -s], [s, c]])
+
+
+# bytes per pixel of the QImage formats that can be shared with numpy
+imageChannels = {
+    QImage.Format_Grayscale8: 1,
+    QImage.Format_RGB888: 3,
+    QImage.Format_RGB32: 4,
+    QImage.Format_ARGB32: 4,
+    QImage.Format_ARGB32_Premultiplied: 4,
+}
+
+
+class ImagePixels:
+    # array interface of the pixels of a QImage, numpy keeps it as base of
+    # the arrays and with it the image alive
+    def __init__(self, img, writable):
+        self.img = img
+        channels = imageChannels[img.format()]
+        ptr = img.bits() if writable else img.constBits()
+        shape = (img.height(), img.width(), channels)
+        strides = (img.bytesPerLine(), channels, 1)
+        if channels == 1:
+            shape = shape[:2]
+            strides = strides[:2]
+        self.__array_interface__ = dict(version=3, typestr="|u1",
+            shape=shape, strides=strides, data=(int(ptr), not writable))
+
+
+def imageArray(img, writable=False):
+    # numpy view onto the pixels of img without copying, rows are
+    # bytesPerLine apart. The view must not be written to if the image
+    # shares its pixels with other QImages.
+    return np.asarray(ImagePixels(img, writable))
+
+
+def imageAffine(img, transform, dst, rotation=0):
+    # the mapping of ImageState.paintImage as 2x3 matrix for cv2.warpAffine:
+    # center of dst + dst width * transform(rotated(p - image center) / width)
+    s = dst.width()/orientedSize(img, rotation).width()
+    a = np.array([[transform.m11(), transform.m21()],
+        [transform.m12(), transform.m22()]]).dot(rotationMatrix(rotation))*s
+    t = (np.array([transform.dx(), transform.dy()])*dst.width()
+        - a.dot([img.width()/2, img.height()/2])
+        + [dst.width()/2, dst.height()/2])
+    # qt samples at pixel centers, opencv uses integer coordinates
+    t += a.dot([0.5, 0.5]) - 0.5
+    return np.hstack([a, t[:,None]])
+
+
+def grayArray(img):
+    # 8 bit grayscale copy of a QImage as numpy array
+    return imageArray(img.convertToFormat(QImage.Format_Grayscale8)).copy()
+
+
+def normalizedPoints(points, img, rotation):
+    # pixel positions to the image coordinates used by paintImage
+    points = (points - (img.width()/2, img.height()/2)).dot(rotationMatrix(rotation).T)
+    return points / orientedSize(img, rotation).width()
+
+
+def estimateAlignment(left, right, workSize=1024):
+    # similarity transform for the right image that makes matched features
+    # fall onto the left ones: no rotation, vertical disparity or size
+    # difference remains and the horizontal disparity is centered at zero
+    l = pickLevel(left.levels, workSize, left.rotation)
+    r = pickLevel(right.levels, workSize, right.rotation)
+    orb = cv2.ORB_create(4000)
+    kl, dl = orb.detectAndCompute(grayArray(l), None)
+    kr, dr = orb.detectAndCompute(grayArray(r), None)
+    if dl is None or dr is None: return None
+    matches = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True).match(dl, dr)
+    if len(matches) < 10: return None
+
+    pl = normalizedPoints(np.float32([kl[m.queryIdx].pt for m in matches]),
+        l, left.rotation)
+    pr = normalizedPoints(np.float32([kr[m.trainIdx].pt for m in matches]),
+        r, right.rotation)
+    # where the left features appear in the view
+    t = left.transform
+    vl = np.stack([t.m11()*pl[:,0] + t.m21()*pl[:,1] + t.dx(),
+        t.m12()*pl[:,0] + t.m22()*pl[:,1] + t.dy()], axis=1)
+
+    m, inliers = cv2.estimateAffinePartial2D(pr, vl, method=cv2.RANSAC,
+        ransacReprojThreshold=2.0/orientedSize(l, left.rotation).width())
+    if m is None or inliers.sum() < 10: return None
+    print("auto alignment from %d of %d matches" % (inliers.sum(), len(matches)))
+    return QTransform(m[0,0], m[1,0], m[0,1], m[1,1], m[0,2], m[1,2])
+
+
+class AutoAligner(QRunnable):
+    def __init__(self, config):
+        super().__init__()
+        self.config = config
+        # the inputs are taken on the gui thread
+        self.snapshot = config.snapshot()
+        self.loadIds = (config.leftState()._loadId, config.rightState()._loadId)
+
+    def run(self):
+        # exceptions must not leave the pool thread, qt would abort
+        try:
+            transform = estimateAlignment(self.snapshot.left, self.snapshot.right)
+        except Exception as e:
+            print("auto alignment failed: "+str(e))
+            transform = None
+        self.config.alignmentFound.emit(self.loadIds, transform)
+
+
+def imageFiles(paths):
+    # the readable images of files and directories, in name order
+    formats = [bytes(f).decode() for f in QImageReader.supportedImageFormats()]
+    files = []
+    for path in map(Path, paths):
+        candidates = path.iterdir() if path.is_dir() else [path]
+        files += [str(f) for f in candidates if f.suffix[1:].lower() in formats]
+    return sorted(files)
+
+
+def burstFeatures(path, thumbSize=512):
+    # orb features of a thumbnail with positions in image widths, cached
+    # by the file contents, None for unreadable files
+    try:
+        key = DiskCache.key("burst", fileHash(path), thumbSize)
+    except OSError as e:
+        print("cannot read "+str(path)+": "+str(e))
+        return None
+    data = diskCache().get(key)
+    if data == None:
+        img = readImage(path, thumbSize)
+        if img == None: return None
+        keypoints, descriptors = cv2.ORB_create(1000).detectAndCompute(
+            grayArray(img), None)
+        if descriptors is None: descriptors = np.zeros((0, 32), np.uint8)
+        data = dict(descriptors=descriptors,
+            points=np.float32([k.pt for k in keypoints]).reshape(-1, 2)/img.width(),
+            width=np.array(img.width()))
+        diskCache().put(key, **data)
+    return data
+
+
+def burstShift(a, b):
+    # (dx, dy, angle) of the contents from frame a to frame b in image
+    # widths and radians, None if they cannot be matched
+    if a == None or b == None or min(len(a["descriptors"]), len(b["descriptors"])) < 10:
+        return None
+    matches = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True).match(
+        a["descriptors"], b["descriptors"])
+    if len(matches) < 10: return None
+    pa = a["points"][[m.queryIdx for m in matches]]
+    pb = b["points"][[m.trainIdx for m in matches]]
+    m, inliers = cv2.estimateAffinePartial2D(pa, pb, method=cv2.RANSAC,
+        ransacReprojThreshold=2.0/int(a["width"]))
+    if m is None or inliers.sum() < 10: return None
+    d = np.median((pb-pa)[inliers[:,0] == 1], axis=0)
+    return (d[0], d[1], math.atan2(m[1,0], m[0,0]))
+
+
+def selectBurstPair(files, targetShift=0.025, candidates=5):
+    # the pair of a burst, shot while sliding sideways, whose contents
+    # moved closest to targetShift image widths with the least vertical
+    # shift and rotation, as (left file, right file)
+    if len(files) < 2: return None
+    with ThreadPoolExecutor(os.cpu_count()) as pool:
+        features = list(pool.map(burstFeatures, files))
+        steps = list(pool.map(burstShift, features[:-1], features[1:]))
+
+    # positions of the frames from the shifts between neighbours, frames
+    # that cannot be matched to their predecessor start a new segment
+    n = len(files)
+    ok = np.array([s != None for s in steps])
+    d = np.array([s[:2] if s != None else (0, 0) for s in steps]).reshape(-1, 2)
+    pos = np.vstack([(0, 0), np.cumsum(d, axis=0)])
+    segment = np.concatenate([[0], np.cumsum(~ok)])
+    dx = pos[None,:,0]-pos[:,None,0]
+    dy = pos[None,:,1]-pos[:,None,1]
+    def score(dx, dy, angle=0):
+        return abs(abs(dx)-targetShift) + 4*abs(dy) + 0.5*abs(angle)
+    scores = score(dx, dy)
+    valid = np.triu(segment[:,None] == segment[None,:], 1)
+    valid &= abs(dx) > targetShift/4
+    if not valid.any(): return None
+
+    # measure the best estimates directly
+    order = np.argsort(np.where(valid, scores, np.inf), axis=None)[:candidates]
+    pairs = [divmod(int(k), n) for k in order if valid.flat[k]]
+    with ThreadPoolExecutor(os.cpu_count()) as pool:
+        shifts = list(pool.map(lambda p: burstShift(features[p[0]], features[p[1]]), pairs))
+    measured = [(score(*shift), pair, shift) for pair, shift in zip(pairs, shifts)
+        if shift != None]
+    if not measured: return None
+    best, (i, j), shift = min(measured, key=lambda m: m[0])
+    print("burst pair %s + %s: shift %.3f, vertical %.4f, angle %.2f°" % (
+        Path(files[i]).name, Path(files[j]).name, shift[0], shift[1],
+        math.degrees(shift[2])))
+    # the contents move left when the camera moves right
+    return (files[i], files[j]) if shift[0] < 0 else (files[j], files[i])
+
+
+class BurstSelector(QRunnable):
+    def __init__(self, config, files):
+        super().__init__()
+        self.config = config
+        self.files = files
+
+    def run(self):
+        # exceptions must not leave the pool thread, qt would abort
+        try:
+            pair = selectBurstPair(self.files)
+        except Exception as e:
+            print("burst selection failed: "+str(e))
+            pair = None
+        self.config.burstPairFound.emit(pair)
+
+
+class ImageLoader(QRunnable):
+    previewSize = 1024
+
+    def __init__(self, state, path, loadId):
+        super().__init__()
+        self.state = state
+        self.path = path
+        self.loadId = loadId
+
+    def cancelled(self):
+        # another file was dropped in the meantime
+        return self.state._loadId != self.loadId
+
+    def run(self):
+        # exceptions must not leave the pool thread, qt would abort
+        try:
+            self.load()
+        except Exception as e:
+            print("cannot load "+str(self.path)+": "+repr(e))
+            self.state.imageLoaded.emit(self.loadId, None, "")
+
+    def load(self):
+        try:
+            contentHash = fileHash(self.path)
+        except OSError:
+            contentHash = ""
+        # a cheap scaled decode first, the jpeg decoder can skip most work.
+        # Proxies of files seen before come from the disk cache.
+        key = DiskCache.key("proxy", contentHash, self.previewSize)
+        with metrics.timed("decode.cache"):
+            img = diskCache().getImage(key) if contentHash else None
+        if img == None:
+            with metrics.timed("decode.preview"):
+                img = readImage(self.path, self.previewSize)
+            if img != None and contentHash: diskCache().putImage(key, img)
+        if self.cancelled(): return
+        if img != None and max(img.width(), img.height()) >= self.previewSize:
+            self.state.previewLoaded.emit(self.loadId, buildLevels(img))
+            with metrics.timed("decode"):
+                img = readImage(self.path)
+            if self.cancelled(): return
+        levels = buildLevels(img) if img != None else None
+        if img == None: contentHash = ""
+        self.state.imageLoaded.emit(self.loadId, levels, contentHash)
+
+
+class ImageSnapshot(namedtuple("ImageSnapshot",
+        "sourceFile levels rotation transform contentHash")):
+    # immutable state of an ImageState, shared with the http and depth
+    # threads without locking. The images are never modified in place,
+    # rotation counts quarter turns applied before the transform. The
+    # content hash is empty until the full image is loaded.
+
+    @property
+    def image(self):
+        # the full resolution image
+        if self.levels == None: return None
+        return self.levels[0]
+
+    def paintImage(self, qp, dst, fullQuality=False, clip=None):
+        # clip defaults to dst, a larger clip paints parts outside of it
+        if (self.levels == None): return
+        if fullQuality:
+            img = self.levels[0]
+        else:
+            # device pixels covered by the image width, with the device
+            # pixel ratio of hidpi screens
+            scale = math.sqrt(abs(qp.deviceTransform().determinant()*
+                self.transform.determinant()))
+            img = pickLevel(self.levels, dst.width()*scale, self.rotation)
+        w = orientedSize(img, self.rotation).width()
+        qp.save()
+        qp.setClipRect(dst if clip == None else clip)
+        qp.translate(dst.x()+dst.width()/2, dst.y()+dst.height()/2)
+        qp.scale(dst.width(), dst.width())
+        qp.setTransform(self.transform, True) # combine with image's transform
+        qp.rotate(90*self.rotation)
+        qp.scale(1.0/w, 1.0/w)
+        qp.translate(-img.width()/2, -img.height()/2)
+        qp.drawImage(0,0, img)
+        qp.restore()
+        #qp.setClipping(False)
+
+    def paintArray(self, out, dst, fullQuality=False, interpolation=None):
+        # same as paintImage but into the BGRA array out with cv2.warpAffine,
+        # does not need any Qt painting and can be used from any thread
+        if (self.levels == None): return
+        if fullQuality:
+            img = self.levels[0]
+        else:
+            scale = math.sqrt(abs(self.transform.determinant()))
+            img = pickLevel(self.levels, dst.width()*scale, self.rotation)
+        if interpolation == None: interpolation = cv2.INTER_NEAREST
+        sub = out[dst.y():dst.y()+dst.height(), dst.x():dst.x()+dst.width()]
+        cv2.warpAffine(imageArray(img),
+            imageAffine(img, self.transform, dst, self.rotation),
+            (dst.width(), dst.height()), sub, interpolation,
+            cv2.BORDER_TRANSPARENT)
+
 
 class ImageState(QObject):
     changed = pyqtSignal()
+    # emitted by the ImageLoader from a pool thread
+    previewLoaded = pyqtSignal(int, object)
+    imageLoaded = pyqtSignal(int, object, str)
 
     def __init__(self, parent=None):
         super().__init__(parent)
         self._sourceFile = None
-        self._image = None
+        self._levels = None
+        self._loadId = 0
+        self._loading = False
+        self._rotation = 0
         self._transform = QTransform()
+        self._contentHash = ""
+        self._snapshot = ImageSnapshot(None, None, 0, QTransform(), "")
+        self.previewLoaded.connect(self._previewLoaded)
+        self.imageLoaded.connect(self._imageLoaded)
+
+    def _publish(self):
+        # replace the snapshot as a whole, then tell everybody
+        self._snapshot = ImageSnapshot(self._sourceFile, self._levels,
+            self._rotation, QTransform(self._transform), self._contentHash)
+        self.changed.emit()
+
+    def snapshot(self): return self._snapshot
 
     def rotate90(self):
+        # only remembered, the pixels are rotated while painting
         if self.image == None: return
-        self._image = self.image.transformed(QTransform().rotate(90))
-        self.changed.emit()
+        self._rotation = (self._rotation+1) % 4
+        self._publish()
+
+    @pyqtProperty(int)
+    def rotation(self): return self._rotation
+
+    @pyqtProperty(str)
+    def contentHash(self): return self._contentHash
+
+    def setGeometry(self, rotation, transform):
+        # both at once, e.g. when restoring a project
+        self._rotation = rotation % 4
+        self._transform = transform
+        self._publish()
 
     @pyqtProperty('QImage')
-    def image(self): return self._image
+    def image(self): return self._snapshot.image
+
+    @pyqtProperty(bool)
+    def loading(self): return self._loading
 
     @pyqtProperty('QTransform')
     def transform(self): return self._transform
@@ -46,36 +701,178 @@ class ImageState(QObject):
     @transform.setter
     def transform(self, value):
         self._transform = value
-        self.changed.emit()
+        self._publish()
 
     @pyqtProperty(str) #'QString'
     def sourceFile(self): return self._sourceFile
 
     @sourceFile.setter
     def sourceFile(self, value):
+        # decoding happens in the background, a newer file cancels it
+        self._sourceFile = value
+        self._loadId += 1
+        self._loading = True
+        self._levels = None
+        self._contentHash = ""
+        self._rotation = 0
+        self._transform = QTransform()
+        self._publish()
+        QThreadPool.globalInstance().start(
+            ImageLoader(self, value, self._loadId))
+
+    def loadFile(self, value):
+        # synchronous variant of setting sourceFile, for headless use
         self._sourceFile = value
-        p = QImageReader(self._sourceFile)
-        if (p.canRead()):
-            p.setAutoTransform(True)
-            self._image = p.read()
-            self._transform = QTransform()
-            print("loaded image "+value)
+        self._loadId += 1
+        with metrics.timed("decode"):
+            img = readImage(value)
+        self._levels = buildLevels(img) if img != None else None
+        self._contentHash = fileHash(value) if img != None else ""
+        self._loading = False
+        self._rotation = 0
+        self._transform = QTransform()
+        self._publish()
+
+    def _previewLoaded(self, loadId, levels):
+        self._swapLevels(loadId, levels, False)
+
+    def _imageLoaded(self, loadId, levels, contentHash):
+        if loadId == self._loadId: self._contentHash = contentHash
+        self._swapLevels(loadId, levels, True)
+
+    def _swapLevels(self, loadId, levels, final):
+        if loadId != self._loadId: return
+        self._levels = levels
+        if final:
+            self._loading = False
+            if levels != None: print("loaded image "+self._sourceFile)
+        self._publish()
+
+    def paintImage(self, qp, dst, fullQuality=False):
+        self._snapshot.paintImage(qp, dst, fullQuality)
+
+    def paintArray(self, out, dst, fullQuality=False, interpolation=None):
+        self._snapshot.paintArray(out, dst, fullQuality, interpolation)
+
+
+class StereoSnapshot(namedtuple("StereoSnapshot",
+        "version left right renderer interpolation")):
+    # both images and the render settings of one version of GlobalConfig
+
+    def paintImage(self, qp, dst, fullQuality=False):
+        # render left image
+        sub = QRect(dst.x(), dst.y(), dst.width()//2, dst.height())
+        self.left.paintImage(qp, sub, fullQuality)
+
+        # render right image
+        sub = QRect(dst.x()+dst.width()//2, dst.y(), dst.width()//2, dst.height())
+        self.right.paintImage(qp, sub, fullQuality)
+
+    def renderImage(self, size, fullQuality=False, layout="sbs"):
+        # size is the side by side size, the other layouts derive from it
+        with metrics.timed("compose"):
+            if layout == "sbs":
+                return self._renderImage(size, fullQuality)
+            if layout == "crosseye":
+                return self.swapped()._renderImage(size, fullQuality)
+            return self.renderLayout(layout,
+                QSize(size.width()//2, size.height()), fullQuality)
+
+    # Dubois' least squares red/cyan anaglyph, rgb of both eyes to rgb
+    duboisLeft = ((0.437, 0.449, 0.164),
+        (-0.062, -0.062, -0.024), (-0.048, -0.050, -0.017))
+    duboisRight = ((-0.011, -0.032, -0.007),
+        (0.377, 0.761, 0.009), (-0.026, -0.093, 1.234))
+
+    @staticmethod
+    def bgraWeights(m):
+        # an rgb to rgb matrix as 4x3 weights from bgra pixels to bgr
+        w = np.zeros((4, 3), np.float32)
+        w[:3] = np.float32(m)[::-1, ::-1].T
+        return w
+
+    def renderLayout(self, layout, eye, fullQuality=False):
+        # both eyes are rendered on their own and combined with numpy,
+        # the pixels are bgra in memory
+        left = self.renderEye(self.left, eye, fullQuality)
+        right = self.renderEye(self.right, eye, fullQuality)
+        l = imageArray(left)
+        r = imageArray(right)
+        if layout == "overunder":
+            img = QImage(eye.width(), 2*eye.height(), QImage.Format_RGB32)
+            out = imageArray(img, True)
+            out[:eye.height()] = l
+            out[eye.height():] = r
+            return img
+
+        img = QImage(eye, QImage.Format_RGB32)
+        out = imageArray(img, True)
+        if layout == "interleaved":
+            # even rows for the left eye, odd rows for the right eye
+            out[0::2] = l[0::2]
+            out[1::2] = r[1::2]
+        elif layout == "anaglyph":
+            # red from the left eye, green and blue from the right eye
+            out[:] = r
+            out[..., 2] = l[..., 2]
+        elif layout == "dubois":
+            mixed = np.matmul(l.astype(np.float32), self.bgraWeights(self.duboisLeft))
+            mixed += np.matmul(r.astype(np.float32), self.bgraWeights(self.duboisRight))
+            np.clip(mixed+0.5, 0, 255, out=mixed)
+            out[..., :3] = mixed
+            out[..., 3] = 255
         else:
-            self._image = None
-        self.changed.emit()
+            raise ValueError("unknown layout "+layout)
+        return img
 
-    def paintImage(self, qp, dst):
-        if (self.image == None): return
-        qp.save()
-        qp.setClipRect(dst)
-        qp.translate(dst.x()+dst.width()/2, dst.y()+dst.height()/2)
-        qp.scale(dst.width(), dst.width())
-        qp.setTransform(self.transform, True) # combine with image's transform
-        qp.scale(1.0/self.image.width(), 1.0/self.image.width())
-        qp.translate(-self.image.width()/2, -self.image.height()/2)
-        qp.drawImage(0,0, self.image)
-        qp.restore()
-        #qp.setClipping(False)
+    def _renderImage(self, size, fullQuality):
+        if self.renderer == "opencv":
+            return self.renderArrayImage(size, fullQuality)
+        # create an image for the final output
+        img = QImage(size, QImage.Format_RGB888)
+        qp = QPainter(img)
+
+        # black background and then the images
+        dst = QRect(0,0,img.width(), img.height())
+        brush = QBrush(Qt.SolidPattern)
+        brush.setColor(Qt.black)
+        qp.setBrush(brush)
+        qp.drawRect(dst)
+        self.paintImage(qp, dst, fullQuality)
+
+        qp.end()
+        return img
+
+    def renderEye(self, state, size, fullQuality=False):
+        # one image on its own, filling the whole size
+        img = QImage(size, QImage.Format_RGB32)
+        img.fill(Qt.black)
+        dst = QRect(QPoint(0,0), size)
+        if self.renderer == "opencv":
+            state.paintArray(imageArray(img, True), dst, fullQuality,
+                GlobalConfig.interpolationFlag(self.interpolation))
+        else:
+            qp = QPainter(img)
+            state.paintImage(qp, dst, fullQuality)
+            qp.end()
+        return img
+
+    def swapped(self):
+        # right image on the left side, for cross-eyed viewing
+        return self._replace(left=self.right, right=self.left)
+
+    def renderArrayImage(self, size, fullQuality=False):
+        # the halves are warped directly into the pixels of the result
+        img = QImage(size, QImage.Format_RGB32)
+        img.fill(Qt.black)
+        out = imageArray(img, True)
+        interpolation = GlobalConfig.interpolationFlag(self.interpolation)
+        w = img.width()//2
+        self.left.paintArray(out, QRect(0, 0, w, img.height()),
+            fullQuality, interpolation)
+        self.right.paintArray(out, QRect(w, 0, w, img.height()),
+            fullQuality, interpolation)
+        return img
 
 
 class GlobalConfig(QObject):
@@ -85,6 +882,98 @@ class GlobalConfig(QObject):
         self.right = ImageState(self)
         self._linked = True
         self._mode = 0
+        self._renderer = "opencv"
+        self._interpolation = "nearest"
+        self._exportSettings = ExportSettings()
+        self._depthSettings = DepthSettings()
+        self._showMetrics = False
+        # repaints the metric overlays while they are shown
+        self._metricsTimer = QTimer(self)
+        self._metricsTimer.setInterval(500)
+        self._metricsTimer.timeout.connect(self.metricsUpdated)
+
+        # every change of the images bumps the version, the rendered
+        # preview frame is only recomputed when the version differs
+        self._version = 0
+        self._versionLock = threading.Lock()
+        self._versionChanged = threading.Condition(self._versionLock)
+        # viewer frames by size and layout, each with the version it was
+        # rendered from and a lock held while it is rendered
+        self._frames = {}
+        self._frameLocks = {}
+        self._frameLock = threading.Lock()
+        self._renderSlots = threading.BoundedSemaphore(self.maxRenders)
+        self._publish()
+        self.left.changed.connect(self.bumpVersion)
+        self.right.changed.connect(self.bumpVersion)
+        self.alignmentFound.connect(self._alignmentFound)
+        self.burstPairFound.connect(self._burstPairFound)
+
+    @pyqtProperty(int)
+    def version(self): return self._version
+
+    # emitted by the AutoAligner from a pool thread
+    alignmentFound = pyqtSignal(object, object)
+    alignmentFinished = pyqtSignal(bool)
+
+    def autoAlign(self):
+        if self.leftState().image == None or self.rightState().image == None:
+            self.alignmentFinished.emit(False)
+            return
+        QThreadPool.globalInstance().start(AutoAligner(self))
+
+    def _alignmentFound(self, loadIds, transform):
+        # ignore the result if an image was replaced in the meantime
+        current = (self.leftState()._loadId, self.rightState()._loadId)
+        if transform != None and loadIds == current:
+            self.rightState().transform = transform
+        else:
+            print("auto alignment failed")
+        self.alignmentFinished.emit(transform != None and loadIds == current)
+
+    # emitted by the BurstSelector from a pool thread
+    burstPairFound = pyqtSignal(object)
+
+    def loadBurst(self, files):
+        # picks the best stereo pair of a burst in the background
+        print("looking for the best pair of %d frames" % len(files))
+        QThreadPool.globalInstance().start(BurstSelector(self, files))
+
+    def _burstPairFound(self, pair):
+        if pair == None:
+            print("no stereo pair found in the burst")
+            return
+        self.leftState().sourceFile = pair[0]
+        self.rightState().sourceFile = pair[1]
+
+    def bumpVersion(self):
+        with self._versionLock:
+            self._version += 1
+            self._publish()
+            self._versionChanged.notify_all()
+
+    def _publish(self):
+        # the images publish their snapshots before they emit changed
+        self._snapshot = StereoSnapshot(self._version,
+            self.left.snapshot(), self.right.snapshot(),
+            self._renderer, self._interpolation)
+
+    def snapshot(self):
+        # consistent state for rendering on any thread
+        return self._snapshot
+
+    def waitForChange(self, version, timeout=None, stopped=None):
+        # blocks until the state differs from version or the event stopped
+        # is set, returns the new version
+        with self._versionLock:
+            self._versionChanged.wait_for(lambda: self._version != version
+                or (stopped != None and stopped.is_set()), timeout)
+            return self._version
+
+    def wakeWaiters(self):
+        # lets waitForChange check its stopped event
+        with self._versionLock:
+            self._versionChanged.notify_all()
 
     linkedChanged = pyqtSignal(int)
     @pyqtProperty(int)
@@ -106,34 +995,130 @@ class GlobalConfig(QObject):
         if old != value: self.modeChanged.emit(value)
     def setMode(self, value): self.mode = value
 
+    showMetricsChanged = pyqtSignal(bool)
+    metricsUpdated = pyqtSignal()
+    @pyqtProperty(bool)
+    def showMetrics(self): return self._showMetrics
+    @showMetrics.setter
+    def showMetrics(self, value):
+        old = self._showMetrics
+        self._showMetrics = value
+        if value: self._metricsTimer.start()
+        else: self._metricsTimer.stop()
+        if old != value: self.showMetricsChanged.emit(value)
+        self.metricsUpdated.emit()
+    def setShowMetrics(self, value): self.showMetrics = (value!=0)
+
     @pyqtProperty(QSize)
     def aspectRatio(self): return QSize(16,9)
 
     @pyqtProperty(QSize)
     def saveSize(self): return self.aspectRatio*120
 
-    def leftState(self): return self.left
-    def rightState(self): return self.right
+    # frame sizes offered to viewers, as multiples of the aspect ratio
+    frameFactors = (40, 80, 120, 160)
 
-    def paintImage(self, qp, dst):
-        # render left image
-        sub = QRect(dst.x(), dst.y(), dst.width()/2, dst.height())
-        self.leftState().paintImage(qp, sub)
+    def frameSize(self, width=0, height=0):
+        # the smallest frame that still fills a screen of width x height
+        if width <= 0 or height <= 0: return self.saveSize
+        a = self.aspectRatio
+        needed = min(width/a.width(), height/a.height())
+        for f in self.frameFactors:
+            if f >= needed: return a*f
+        return a*self.frameFactors[-1]
 
-        # render right image
-        sub = QRect(dst.x()+dst.width()/2, dst.y(), dst.width()/2, dst.height())
-        self.rightState().paintImage(qp, sub)
+    def leftState(self): return self.left
+    def rightState(self): return self.right
 
-    def proposeFilename(self):
+    def paintImage(self, qp, dst, fullQuality=False):
+        self.snapshot().paintImage(qp, dst, fullQuality)
+
+    # renderImage either paints with QPainter or warps with opencv
+    renderers = ("opencv", "qt")
+    interpolations = {"nearest": "INTER_NEAREST", "linear": "INTER_LINEAR",
+        "cubic": "INTER_CUBIC", "lanczos": "INTER_LANCZOS4"}
+
+    @staticmethod
+    def interpolationFlag(name):
+        # looked up on use, so that opencv is only imported when needed
+        return getattr(cv2, GlobalConfig.interpolations[name])
+
+    @pyqtProperty(str)
+    def renderer(self): return self._renderer
+    @renderer.setter
+    def renderer(self, value):
+        self._renderer = value
+        self.bumpVersion()
+
+    @pyqtProperty(str)
+    def interpolation(self): return self._interpolation
+    @interpolation.setter
+    def interpolation(self, value):
+        self._interpolation = value
+        self.bumpVersion()
+
+    def renderImage(self, size, fullQuality=False, layout="sbs"):
+        return self.snapshot().renderImage(size, fullQuality, layout)
+
+    # viewer frames rendered at the same time, more viewers only wait
+    maxRenders = max(2, (os.cpu_count() or 1)//2)
+
+    def currentFrame(self, size=None, layout="sbs"):
+        # returns (version, jpeg bytes), rendered at most once per version,
+        # size and layout, all viewers asking for the same share the frame
+        if size is None: size = self.saveSize
+        key = (size.width(), size.height(), layout)
+        with self._frameLock:
+            lock = self._frameLocks.setdefault(key, threading.Lock())
+        # other sizes and layouts render at the same time
+        with lock:
+            snapshot = self.snapshot()
+            frame = self._frames.get(key)
+            if frame is None or frame[0] != snapshot.version:
+                with self._renderSlots:
+                    img = snapshot.renderImage(size, False, layout)
+                    with metrics.timed("encode"):
+                        buffer = QBuffer()
+                        buffer.open(QBuffer.ReadWrite)
+                        img.save(buffer, "JPG")
+                frame = (snapshot.version, bytes(buffer.data()))
+                self._frames[key] = frame
+                metrics.count("frames.rendered")
+            else:
+                metrics.count("frames.shared")
+            return frame
+
+    exportSettingsChanged = pyqtSignal()
+    @pyqtProperty(object)
+    def exportSettings(self): return self._exportSettings
+    @exportSettings.setter
+    def exportSettings(self, value):
+        self._exportSettings = value
+        self.exportSettingsChanged.emit()
+
+    depthSettingsChanged = pyqtSignal()
+    @pyqtProperty(object)
+    def depthSettings(self): return self._depthSettings
+    @depthSettings.setter
+    def depthSettings(self, value):
+        self._depthSettings = value
+        self.depthSettingsChanged.emit()
+
+    def proposeFilename(self, suffix=".jpg"):
         if (self.leftState().image == None or
-            self.rightState().image == None):
+            self.rightState().image == None or
+            self.leftState().loading or self.rightState().loading):
             return None
         pl = Path(self.leftState().sourceFile)
         pr = Path(self.rightState().sourceFile)
-        return str(pl.parent.joinpath(pl.stem+"-"+pr.stem+".jpg"))
+        return str(pl.parent.joinpath(pl.stem+"-"+pr.stem+suffix))
 
 
 class ImageView(QWidget):
+    # margin of the cached image while moving, in view sizes
+    cacheMargin = 0.5
+    # exact redraw after the last shift of the cached image, in ms
+    refineDelay = 150
     mousePress = pyqtSignal('QMouseEvent')
     mouseMove = pyqtSignal('QMouseEvent')
     mouseRelease = pyqtSignal('QMouseEvent')
@@ -154,7 +1139,15 @@ class ImageView(QWidget):
             self.config.aspectRatio.height()*100)
         # self.setSizeConstraint(QLayout.SetMinAndMaxSize)
         self.setAcceptDrops(True)
-        self.state.changed.connect(self.repaint)
+        self._cache = None
+        self._guides = None
+        self._refineTimer = QTimer(self)
+        self._refineTimer.setSingleShot(True)
+        self._refineTimer.setInterval(self.refineDelay)
+        self._refineTimer.timeout.connect(self.refine)
+        # repaints are coalesced by the event loop
+        self.state.changed.connect(self.update)
+        if self.right: self.config.metricsUpdated.connect(self.update)
 
     def sizeHint(self):
         return QSize(self.config.aspectRatio.width()*100/2,
@@ -177,7 +1170,12 @@ class ImageView(QWidget):
 
     def dropEvent(self, e):
         # could use e.pos() to see if it is in the left or right half
-        self.state.sourceFile = e.mimeData().urls()[0].toLocalFile()
+        paths = [u.toLocalFile() for u in e.mimeData().urls() if u.isLocalFile()]
+        if len(paths) == 1 and not Path(paths[0]).is_dir():
+            self.state.sourceFile = paths[0]
+        else:
+            # a burst as several frames or a directory
+            self.config.loadBurst(imageFiles(paths))
 
     def imgRect(self):
         aw = self.config.aspectRatio.width()
@@ -193,114 +1191,503 @@ class ImageView(QWidget):
         return QRect(x,0,w,h)
 
     def paintEvent(self, event):
+        start = time.perf_counter()
         dst = self.imgRect()
+        snapshot = self.state.snapshot()
+        offset = self.cacheOffset(snapshot, dst)
+        if offset is None:
+            self._cache = self.renderCache(snapshot, dst)
+            offset = QPointF(0, 0)
+        elif not offset.isNull():
+            # only moved, redraw exactly once the image rests
+            self._refineTimer.start()
+
         qp = QPainter()
         qp.begin(self)
-
-        # draw background
-        brush = QBrush(Qt.SolidPattern)
-        # brush.setColor(Qt.white)
-        brush.setColor(Qt.black)
-        qp.setBrush(brush)
-        qp.drawRect(dst)
-        # brush = QBrush(Qt.DiagCrossPattern)
-        # brush.setColor(Qt.black)
-        # qp.setBrush(brush)
-        # qp.drawRect(dst)
-
-        self.state.paintImage(qp, dst)
-
-        # draw orientation lines
-        qp.setPen(QColor(255,255,255,150))
-        qp.drawLine(dst.x()+dst.width()/3,dst.y()+0,
-            dst.x()+dst.width()/3,dst.y()+dst.height())
-        qp.drawLine(dst.x()+dst.width()/2,dst.y()+0,
-            dst.x()+dst.width()/2,dst.y()+dst.height())
-        qp.drawLine(dst.x()+dst.width()*2/3,dst.y()+0,
-            dst.x()+dst.width()*2/3,dst.y()+dst.height())
-        qp.drawLine(dst.x()+0,dst.y()+dst.height()/3,
-            dst.x()+dst.width(),dst.y()+dst.height()/3)
-        qp.drawLine(dst.x()+0,dst.y()+dst.height()/2,
-            dst.x()+dst.width(),dst.y()+dst.height()/2)
-        qp.drawLine(dst.x()+0,dst.y()+dst.height()*2/3,
-            dst.x()+dst.width(),dst.y()+dst.height()*2/3)
-
+        qp.setClipRect(dst)
+        qp.drawPixmap(QPointF(dst.topLeft()-self._cache.margin)+offset,
+            self._cache.pixmap)
+        qp.setClipping(False)
+        qp.drawPixmap(dst.topLeft(), self.guides(dst.size()))
+
+        if self.right and self.config.showMetrics:
+            paintMetrics(qp, dst, metrics.summary(("decode", "compose",
+                "paint", "encode", "frames", "serve", "http", "viewers", "streams")))
+        qp.end()
+        metrics.record("paint", time.perf_counter()-start)
+
+    def cacheOffset(self, snapshot, dst):
+        # where the cached pixmap has to be drawn to show snapshot, None
+        # if it cannot be reused
+        c = self._cache
+        if c is None or c.levels is not snapshot.levels or \
+                c.rotation != snapshot.rotation or c.size != dst.size() or \
+                c.pixmap.devicePixelRatio() != self.devicePixelRatioF():
+            return None
+        t0 = c.transform
+        t = snapshot.transform
+        if (t0.m11(), t0.m12(), t0.m21(), t0.m22()) != (t.m11(), t.m12(), t.m21(), t.m22()):
+            return None
+        offset = QPointF(t.dx()-t0.dx(), t.dy()-t0.dy())*dst.width()
+        if abs(offset.x()) > c.margin.x() or abs(offset.y()) > c.margin.y():
+            return None
+        return offset
+
+    def renderCache(self, snapshot, dst):
+        # while moving, the image is rendered with a margin around the view
+        # so that drags only have to shift the pixmap
+        margin = QPoint(0, 0)
+        if self.config.mode == 1:
+            margin = QPoint(int(dst.width()*self.cacheMargin),
+                int(dst.height()*self.cacheMargin))
+        size = QSize(dst.width()+2*margin.x(), dst.height()+2*margin.y())
+        dpr = self.devicePixelRatioF()
+        pixmap = QPixmap(size*dpr)
+        pixmap.setDevicePixelRatio(dpr)
+        pixmap.fill(Qt.black)
+        qp = QPainter(pixmap)
+        snapshot.paintImage(qp, QRect(margin, dst.size()), False,
+            QRect(QPoint(0, 0), size))
         qp.end()
+        return ViewCache(pixmap, snapshot.levels, snapshot.rotation,
+            QTransform(snapshot.transform), dst.size(), margin)
+
+    def refine(self):
+        self._cache = None
+        self.update()
+
+    def guides(self, size):
+        # orientation lines in thirds and halves, drawn once per size
+        if self._guides is None or self._guides.size() != size*self.devicePixelRatioF():
+            dpr = self.devicePixelRatioF()
+            self._guides = QPixmap(size*dpr)
+            self._guides.setDevicePixelRatio(dpr)
+            self._guides.fill(Qt.transparent)
+            qp = QPainter(self._guides)
+            qp.setPen(QColor(255,255,255,150))
+            w = size.width()
+            h = size.height()
+            for x in (w/3, w/2, w*2/3):
+                qp.drawLine(QPointF(x, 0), QPointF(x, h))
+            for y in (h/3, h/2, h*2/3):
+                qp.drawLine(QPointF(0, y), QPointF(w, y))
+            qp.end()
+        return self._guides
+
+
+class ViewCache(namedtuple("ViewCache",
+        "pixmap levels rotation transform size margin")):
+    # a rendered image of an ImageView and what it was rendered from
+    pass
+
+
+class StaticAsset(namedtuple("StaticAsset", "data gzipped ctype etag cacheControl")):
+    @classmethod
+    def load(cls, file, ctype, cacheControl):
+        data = Path(__file__).parent.joinpath(file).read_bytes()
+        return cls(data, gzip.compress(data), ctype,
+            '"%s"' % hashlib.sha1(data).hexdigest()[:16], cacheControl)
+
+
+class ImageServer(ThreadingHTTPServer):
+    # one thread per connection, but at most maxConnections of them. Streams
+    # and idle keep-alive connections hold one too, so the limit only keeps
+    # the threads in bounds, GlobalConfig.maxRenders limits the rendering.
+    # Further clients are turned away until a viewer disconnects.
+    maxConnections = 256
+
+    def __init__(self, address, appconfig):
+        super().__init__(address, ImageWebserver)
+        self.appconfig = appconfig
+        self.slots = threading.BoundedSemaphore(self.maxConnections)
+        # versions start at 0 again after a restart, the token keeps etags
+        # of an earlier server from matching
+        self.token = os.urandom(4).hex()
+        # open connections, ended by server_close
+        self.stopped = threading.Event()
+        self.connections = set()
+        self.connectionsLock = threading.Lock()
+        # read once, the jquery files never change
+        immutable = "public, max-age=31536000, immutable"
+        self.assets = {
+            "/": StaticAsset.load("index.html", "text/html; charset=utf-8", "no-cache"),
+            "/jquery-3.3.1.min.js": StaticAsset.load("jquery-3.3.1.min.js",
+                "application/javascript; charset=utf-8", immutable),
+            "/jquery.fullscreen.min.js": StaticAsset.load("jquery.fullscreen.min.js",
+                "application/javascript; charset=utf-8", immutable),
+        }
+
+    def process_request(self, request, client_address):
+        if not self.slots.acquire(blocking=False):
+            metrics.count("http.rejected")
+            try:
+                request.sendall(b"HTTP/1.1 503 Service Unavailable\r\n"
+                    b"Retry-After: 1\r\nContent-Length: 0\r\n"
+                    b"Connection: close\r\n\r\n")
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        super().process_request(request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        metrics.gauge("viewers", 1)
+        with self.connectionsLock:
+            self.connections.add(request)
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            with self.connectionsLock:
+                self.connections.discard(request)
+            metrics.gauge("viewers", -1)
+            self.slots.release()
+
+    def server_close(self):
+        # shutdown only stops accepting, streams would go on sending
+        self.stopped.set()
+        self.appconfig.wakeWaiters()
+        with self.connectionsLock:
+            for request in self.connections:
+                try:
+                    request.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        super().server_close()
 
 
 class ImageWebserver(BaseHTTPRequestHandler):
+    # keep-alive, every response but the stream has a Content-Length
+    protocol_version = "HTTP/1.1"
+    # idle keep-alive connections give their slot back after this many seconds
+    timeout = 30
+    # frame rate cap of the live stream, changes in between are coalesced
+    streamInterval = 1.0/15
+    # resend the current frame after this many seconds without changes
+    streamKeepalive = 10
+
     def do_GET(self):
-        if self.path == "/":
-            self.serveFile("index.html", "text/html; charset=utf-8")
-        elif self.path == "/jquery-3.3.1.min.js":
-            self.serveFile("jquery-3.3.1.min.js", "text/plain; charset=utf-8")
-        elif self.path == "/jquery.fullscreen.min.js":
-            self.serveFile("jquery.fullscreen.min.js", "text/plain; charset=utf-8")
-        elif self.path.startswith("/img.jpg?"):
-            self.serveImage()
+        metrics.count("http.requests")
+        url = urlsplit(self.path)
+        if url.path in self.server.assets:
+            with metrics.timed("serve.asset"):
+                self.serveAsset(self.server.assets[url.path])
+        elif url.path == "/img.jpg":
+            with metrics.timed("serve.image"):
+                self.serveImage(*self.frameFormat(url.query))
+        elif url.path == "/stream.mjpg":
+            self.serveStream(*self.frameFormat(url.query))
+        elif url.path == "/metrics":
+            self.serveMetrics()
         else:
+            body = ("<html><head><title>no file</title></head>"
+                "<body><p>Wrong address</p>"
+                "<p>You accessed path: %s</p>"
+                "</body></html>" % self.path).encode('utf-8')
             self.send_response(404)
             self.send_header("Content-type", "text/html")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def serveAsset(self, asset):
+        if self.headers.get("If-None-Match") == asset.etag:
+            self.send_response(304)
+            self.send_header("ETag", asset.etag)
+            self.send_header("Cache-Control", asset.cacheControl)
             self.end_headers()
-            self.wfile.write("<html><head><title>no file</title></head>".encode('utf-8'))
-            self.wfile.write("<body><p>Wrong address</p>".encode('utf-8'))
-            self.wfile.write(("<p>You accessed path: %s</p>" % self.path).encode('utf-8'))
-            self.wfile.write("</body></html>".encode('utf-8'))
+            return
 
-    def serveFile(self, file, ctype):
+        data = asset.data
         self.send_response(200)
-        self.send_header("Content-type", ctype)
+        self.send_header("Content-type", asset.ctype)
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            data = asset.gzipped
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Cache-Control", asset.cacheControl)
+        self.send_header("ETag", asset.etag)
         self.end_headers()
-        source = open(Path(sys.argv[0]).parent.joinpath(file), 'rb')
-        shutil.copyfileobj(source, self.wfile)
+        self.wfile.write(data)
+
+    def serveMetrics(self):
+        data = json.dumps(metrics.asDict(), indent=2).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def frameFormat(self, query):
+        # the viewer reports its screen in device pixels as ?w=...&h=...
+        # and may ask for another layout than side by side with &layout=
+        args = parse_qs(query)
+        try:
+            w = int(args.get("w", ["0"])[0])
+            h = int(args.get("h", ["0"])[0])
+        except ValueError:
+            w = h = 0
+        layout = args.get("layout", ["sbs"])[0]
+        if layout not in dict(ExportSettings.layouts): layout = "sbs"
+        return (self.server.appconfig.frameSize(w, h), layout)
+
+    def serveImage(self, size, layout):
+        version, data = self.server.appconfig.currentFrame(size, layout)
+        etag = '"%s-%d-%d-%s"' % (self.server.token, version, size.width(), layout)
+
+        # the viewer already shows the current frame
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
 
-    def serveImage(self):
         self.send_response(200)
         self.send_header("Content-type", "image/jpeg")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("ETag", etag)
         self.end_headers()
+        self.wfile.write(data)
 
+    def serveStream(self, size, layout):
         cfg = self.server.appconfig
-        # create an image for the final output
-        img = QImage(cfg.saveSize, QImage.Format_RGB888)
-        qp = QPainter(img)
-        # black background and then the images
-        dst = QRect(0,0,img.width(), img.height())
-        brush = QBrush(Qt.SolidPattern)
-        brush.setColor(Qt.black)
-        qp.setBrush(brush)
-        qp.drawRect(dst)
-        cfg.paintImage(qp, dst)
-        qp.end()
+        self.send_response(200)
+        self.send_header("Content-type", "multipart/x-mixed-replace; boundary=frame")
+        self.send_header("Cache-Control", "no-cache")
+        # the stream has no length, it ends with the connection
+        self.send_header("Connection", "close")
+        self.close_connection = True
+        self.end_headers()
 
-        buffer = QBuffer()
-        buffer.open(QBuffer.ReadWrite)
-        img.save(buffer, "JPG")
-        self.wfile.write(buffer.data())
+        version = None
+        metrics.gauge("streams", 1)
+        try:
+            self.wfile.write(b"--frame\r\n")
+            while not self.server.stopped.is_set():
+                cfg.waitForChange(version, self.streamKeepalive,
+                    self.server.stopped)
+                if self.server.stopped.is_set(): break
+                # renders the latest state, intermediate versions are skipped
+                version, data = cfg.currentFrame(size, layout)
+                sent = time.monotonic()
+
+                # the closing boundary makes browsers show the frame at once
+                self.wfile.write(b"Content-Type: image/jpeg\r\n")
+                self.wfile.write(("Content-Length: %d\r\n\r\n" % len(data)).encode('utf-8'))
+                self.wfile.write(data)
+                self.wfile.write(b"\r\n--frame\r\n")
+                self.wfile.flush()
+                metrics.count("streams.frames")
+
+                time.sleep(max(0, sent + self.streamInterval - time.monotonic()))
+        except OSError:
+            # the viewer went away or stopped reading
+            pass
+        finally:
+            metrics.gauge("streams", -1)
+
+
+class ExportSettings(namedtuple("ExportSettings",
+        "preset format quality progressive subsampling layout")):
+    # output sizes as multiples of the aspect ratio, "original" keeps the
+    # resolution of the source images
+    presets = (("720p", "720p (HD)", 80), ("1080p", "1080p (Full HD)", 120),
+        ("1440p", "1440p (QHD Handys)", 160), ("2160p", "2160p (4K)", 240),
+        ("original", "Originalgröße", 0))
+    # jps is a jpeg with the right image on the left, mpo holds both
+    # images in one file (CIPA DC-007)
+    formats = ("jpg", "png", "webp", "jps", "mpo")
+    subsamplings = ("4:2:0", "4:2:2", "4:4:4")
+    # arrangements of the eyes for jpg, png and webp. Over/under, row
+    # interleaved and the anaglyphs use eyes of half the preset width.
+    layouts = (("sbs", "Nebeneinander"), ("crosseye", "Kreuzblick"),
+        ("overunder", "Übereinander"), ("interleaved", "Zeilenweise"),
+        ("anaglyph", "Anaglyph rot/cyan"), ("dubois", "Anaglyph Dubois"))
+
+    def __new__(cls, preset="1080p", format="jpg", quality=90,
+            progressive=False, subsampling="4:2:0", layout="sbs"):
+        return super().__new__(cls, preset, format, quality, progressive,
+            subsampling, layout)
+
+    def size(self, snapshot, aspectRatio):
+        factor = dict((p[0], p[2]) for p in self.presets)[self.preset]
+        if factor > 0: return aspectRatio*factor
+        # the image width fills the eye width, so the narrower source image
+        # gives the eye width, the height follows from the aspect ratio
+        w = min(orientedSize(s.image, s.rotation).width()
+            for s in (snapshot.left, snapshot.right))
+        return QSize(2*w, 2*w*aspectRatio.height()//aspectRatio.width()//2*2)
+
+    def stereoFormat(self):
+        # jps and mpo define the arrangement themselves
+        return self.format in ("jps", "mpo")
+
+    def suffix(self):
+        if self.layout == "sbs" or self.stereoFormat(): return "."+self.format
+        return "-"+self.layout+"."+self.format
+
+    def encoderParams(self):
+        if self.format in ("jpg", "jps", "mpo"):
+            params = [cv2.IMWRITE_JPEG_QUALITY, self.quality,
+                cv2.IMWRITE_JPEG_PROGRESSIVE, int(self.progressive)]
+            # needs opencv 4.5.5 or newer
+            if hasattr(cv2, "IMWRITE_JPEG_SAMPLING_FACTOR"):
+                params += [cv2.IMWRITE_JPEG_SAMPLING_FACTOR, {
+                    "4:2:0": cv2.IMWRITE_JPEG_SAMPLING_FACTOR_420,
+                    "4:2:2": cv2.IMWRITE_JPEG_SAMPLING_FACTOR_422,
+                    "4:4:4": cv2.IMWRITE_JPEG_SAMPLING_FACTOR_444}[self.subsampling]]
+            return ".jpg", params
+        if self.format == "webp":
+            return ".webp", [cv2.IMWRITE_WEBP_QUALITY, self.quality]
+        return ".png", [cv2.IMWRITE_PNG_COMPRESSION, 6]
+
+
+def encodeImage(img, settings):
+    # compressed bytes of an image, opencv expects the bgr(a) byte order
+    # of RGB32 images
+    if imageChannels.get(img.format()) != 4:
+        img = img.convertToFormat(QImage.Format_RGB32)
+    ext, params = settings.encoderParams()
+    ok, data = cv2.imencode(ext, imageArray(img)[:,:,:3], params)
+    if not ok: raise IOError("cannot encode "+ext)
+    return data.tobytes()
+
+
+def mpoSegment(entries):
+    # APP2 segment with an MP index IFD (entries is a list of
+    # (attribute, size, offset)) or, without entries, an attribute IFD
+    tags = [(0xB000, 7, 4, b"0100")]
+    if entries:
+        tags += [(0xB001, 4, 1, struct.pack(">I", len(entries))),
+            (0xB002, 7, 16*len(entries), None)]
+    else:
+        tags += [(0xB101, 4, 1, struct.pack(">I", 2))]
+    valueOffset = 8+2+12*len(tags)+4
+    ifd = struct.pack(">H", len(tags))
+    for tag, kind, count, value in tags:
+        if value == None: value = struct.pack(">I", valueOffset)
+        ifd += struct.pack(">HHI", tag, kind, count)+value
+    ifd += struct.pack(">I", 0)
+    for attribute, size, offset in entries:
+        ifd += struct.pack(">IIIHH", attribute, size, offset, 0, 0)
+    tiff = b"MM\x00\x2a"+struct.pack(">I", 8)+ifd
+    return b"\xff\xe2"+struct.pack(">H", 2+4+len(tiff))+b"MPF\x00"+tiff
+
+
+def insertSegment(jpeg, segment):
+    # behind SOI and the APP0/APP1 segments, returns the position as well
+    pos = 2
+    while jpeg[pos:pos+2] in (b"\xff\xe0", b"\xff\xe1"):
+        pos += 2+struct.unpack(">H", jpeg[pos+2:pos+4])[0]
+    return jpeg[:pos]+segment+jpeg[pos:], pos
+
+
+def mpoBytes(left, right):
+    # multi picture object of two jpegs, both marked as disparity images
+    second, pos = insertSegment(right, mpoSegment([]))
+    placeholder = mpoSegment([(0, 0, 0), (0, 0, 0)])
+    first, pos = insertSegment(left, placeholder)
+    # offsets count from the byte order mark behind "MPF\0"
+    header = pos+8
+    segment = mpoSegment([(0x20020002, len(first), 0),
+        (0x00020002, len(second), len(first)-header)])
+    first = first[:pos]+segment+first[pos+len(placeholder):]
+    return first+second
+
+
+def exportSnapshot(snapshot, settings, size, dstFile, progress=lambda p: None):
+    # render, encode and write one export, always from the full resolution
+    if settings.format == "mpo":
+        eye = QSize(size.width()//2, size.height())
+        left = snapshot.renderEye(snapshot.left, eye, True)
+        progress(25)
+        right = snapshot.renderEye(snapshot.right, eye, True)
+        progress(50)
+        left = encodeImage(left, settings)
+        progress(70)
+        data = mpoBytes(left, encodeImage(right, settings))
+    else:
+        if settings.format == "jps": snapshot = snapshot.swapped()
+        layout = "sbs" if settings.stereoFormat() else settings.layout
+        img = snapshot.renderImage(size, True, layout)
+        progress(40)
+        data = encodeImage(img, settings)
+    progress(90)
+    Path(dstFile).write_bytes(data)
+    progress(100)
+
+
+class ExportThread(QThread):
+    progress = pyqtSignal(int)
+    exported = pyqtSignal(str)
+    failed = pyqtSignal(str)
+
+    def __init__(self, config, dstFile, parent=None):
+        super().__init__(parent)
+        # everything is taken on the gui thread
+        self.snapshot = config.snapshot()
+        self.settings = config.exportSettings
+        self.size = self.settings.size(self.snapshot, config.aspectRatio)
+        self.dstFile = dstFile
+
+    def run(self):
+        try:
+            exportSnapshot(self.snapshot, self.settings, self.size,
+                self.dstFile, self.progress.emit)
+            self.exported.emit(self.dstFile)
+        except (IOError, cv2.error) as e:
+            self.failed.emit(str(e))
 
 
 class ImageWindow(QWidget):
+    # the web server tries a few ports after the first one before it takes
+    # any free port
+    port = 12345
+    portAttempts = 10
+
     def __init__(self, config, parent=None):
         super().__init__(parent)
         self.config = config
+        # created on demand
+        self.httpd = None
+        self.depthWindow = None
 
         self.setWindowTitle('3D Vorschau')
 
         vbox = QVBoxLayout()
 
         # buttons for global operations, modes
-        save = QPushButton("Speichern")
-        save.clicked.connect(self.saveTriggered)
+        self._saveBtn = QPushButton("Speichern")
+        self._saveBtn.clicked.connect(self.saveTriggered)
+        self._exportThread = None
 
         rotleft = QPushButton("Linkes drehen")
         rotleft.clicked.connect(self.config.leftState().rotate90)
         rotright = QPushButton("Rechtes drehen")
         rotright.clicked.connect(self.config.rightState().rotate90)
 
+        self._alignBtn = QPushButton("Automatisch ausrichten")
+        self._alignBtn.clicked.connect(self.autoAlign)
+        self.config.alignmentFinished.connect(
+            lambda ok: self._alignBtn.setEnabled(True))
+
         self._linkedBtn = QCheckBox("verbunden", self)
         self._linkedBtn.setChecked(self.config.linked)
         self._linkedBtn.stateChanged.connect(self.config.setLinked)
         self.config.linkedChanged.connect(self.setLinked)
 
+        self._metricsBtn = QCheckBox("Messwerte", self)
+        self._metricsBtn.setChecked(self.config.showMetrics)
+        self._metricsBtn.stateChanged.connect(self.config.setShowMetrics)
+        self.config.showMetricsChanged.connect(self._metricsBtn.setChecked)
+
+        self._depthBtn = QPushButton("Tiefenkarte")
+        self._depthBtn.clicked.connect(self.showDepth)
+        self._serverBtn = QCheckBox("Webserver", self)
+        self._serverBtn.toggled.connect(self.setServer)
+
         self._modeGroup = QButtonGroup(self)
         self._modeGroup.addButton(QRadioButton("skalieren",self),0)
         self._modeGroup.addButton(QRadioButton("schieben",self),1)
@@ -311,17 +1698,59 @@ class ImageWindow(QWidget):
         self.config.modeChanged.connect(self.setMode)
 
         tb = QHBoxLayout()
-        tb.addWidget(save)
+        tb.addWidget(self._saveBtn)
         tb.addStretch(1)
         tb.addWidget(rotleft)
         tb.addWidget(rotright)
+        tb.addWidget(self._alignBtn)
         tb.addWidget(self._linkedBtn)
         tb.addWidget(self._modeGroup.button(0))
         tb.addWidget(self._modeGroup.button(1))
         tb.addWidget(self._modeGroup.button(2))
         tb.addWidget(self._modeGroup.button(3))
+        tb.addWidget(self._depthBtn)
+        tb.addWidget(self._serverBtn)
+        tb.addWidget(self._metricsBtn)
         vbox.addLayout(tb)
 
+        # export options
+        self._presetBox = QComboBox(self)
+        for key, name, factor in ExportSettings.presets:
+            self._presetBox.addItem(name, key)
+        self._formatBox = QComboBox(self)
+        for key in ExportSettings.formats:
+            self._formatBox.addItem(key.upper(), key)
+        self._qualityBox = QSpinBox(self)
+        self._qualityBox.setRange(1, 100)
+        self._progressiveBtn = QCheckBox("progressiv", self)
+        self._subsamplingBox = QComboBox(self)
+        for key in ExportSettings.subsamplings:
+            self._subsamplingBox.addItem(key, key)
+        self._layoutBox = QComboBox(self)
+        for key, name in ExportSettings.layouts:
+            self._layoutBox.addItem(name, key)
+        self._progressBar = QProgressBar(self)
+        self._progressBar.setVisible(False)
+        self.setExportSettings()
+        self.config.exportSettingsChanged.connect(self.setExportSettings)
+        for box in (self._presetBox, self._formatBox, self._subsamplingBox,
+                self._layoutBox):
+            box.currentIndexChanged.connect(self.exportSettingsChanged)
+        self._qualityBox.valueChanged.connect(self.exportSettingsChanged)
+        self._progressiveBtn.stateChanged.connect(self.exportSettingsChanged)
+
+        eb = QHBoxLayout()
+        eb.addWidget(self._presetBox)
+        eb.addWidget(self._layoutBox)
+        eb.addWidget(self._formatBox)
+        eb.addWidget(QLabel("Qualität", self))
+        eb.addWidget(self._qualityBox)
+        eb.addWidget(self._progressiveBtn)
+        eb.addWidget(self._subsamplingBox)
+        eb.addWidget(self._progressBar)
+        eb.addStretch(1)
+        vbox.addLayout(eb)
+
         # the views to the left and right image
         self.leftImage = ImageView(self.config.leftState(), self.config, False)
         self.rightImage = ImageView(self.config.rightState(), self.config, True)
@@ -335,20 +1764,87 @@ class ImageWindow(QWidget):
         vbox.addLayout(imgbox)
         self.setLayout(vbox)
 
+        self.project = ProjectFile(self.config, self)
+
         self.leftImage.mousePress.connect(self.mousePressL)
         self.leftImage.mouseMove.connect(self.mouseMove)
         self.rightImage.mousePress.connect(self.mousePressR)
         self.rightImage.mouseMove.connect(self.mouseMove)
 
-        self.httpd = ThreadingHTTPServer(('', 12345), ImageWebserver)
-        self.httpd.appconfig = self.config
+    def closeEvent(self, e):
+        self.stopServer()
+        if self.depthWindow != None: self.depthWindow.close()
+
+    def showDepth(self):
+        # the depth window and its render thread are only created when needed
+        if self.depthWindow == None:
+            self.depthWindow = DepthWindow(self.config)
+        self.depthWindow.show()
+        self.depthWindow.raise_()
+        self.depthWindow.activateWindow()
+
+    def setServer(self, on):
+        if on: self.startServer()
+        else: self.stopServer()
+
+    def startServer(self, port=None):
+        if self.httpd != None: return True
+        if port != None: self.port = port
+        for p in list(range(self.port, self.port+self.portAttempts))+[0]:
+            try:
+                self.httpd = ImageServer(('', p), self.config)
+                break
+            except OSError as e:
+                print("port "+str(p)+" not available: "+str(e))
+        else:
+            self._serverBtn.setChecked(False)
+            return False
         self.httpd_thread = threading.Thread(target=self.httpd.serve_forever)
         self.httpd_thread.daemon = True
         self.httpd_thread.start()
-
-    def closeEvent(self, e):
+        port = self.httpd.server_address[1]
+        print("web server on port "+str(port))
+        self._serverBtn.blockSignals(True)
+        self._serverBtn.setChecked(True)
+        self._serverBtn.blockSignals(False)
+        self._serverBtn.setText("Webserver :"+str(port))
+        return True
+
+    def stopServer(self):
+        if self.httpd == None: return
         self.httpd.shutdown()
         self.httpd.server_close()
+        self.httpd = None
+        self._serverBtn.blockSignals(True)
+        self._serverBtn.setChecked(False)
+        self._serverBtn.blockSignals(False)
+        self._serverBtn.setText("Webserver")
+
+    def autoAlign(self):
+        self._alignBtn.setEnabled(False)
+        self.config.autoAlign()
+
+    def setExportSettings(self):
+        settings = self.config.exportSettings
+        widgets = (self._presetBox, self._formatBox, self._qualityBox,
+            self._progressiveBtn, self._subsamplingBox, self._layoutBox)
+        for w in widgets: w.blockSignals(True)
+        self._presetBox.setCurrentIndex(self._presetBox.findData(settings.preset))
+        self._formatBox.setCurrentIndex(self._formatBox.findData(settings.format))
+        self._qualityBox.setValue(settings.quality)
+        self._progressiveBtn.setChecked(settings.progressive)
+        self._subsamplingBox.setCurrentIndex(
+            self._subsamplingBox.findData(settings.subsampling))
+        self._layoutBox.setCurrentIndex(self._layoutBox.findData(settings.layout))
+        # jps and mpo are always stereo pairs
+        self._layoutBox.setEnabled(not settings.stereoFormat())
+        for w in widgets: w.blockSignals(False)
+
+    def exportSettingsChanged(self):
+        self.config.exportSettings = ExportSettings(
+            self._presetBox.currentData(), self._formatBox.currentData(),
+            self._qualityBox.value(), self._progressiveBtn.isChecked(),
+            self._subsamplingBox.currentData(), self._layoutBox.currentData())
 
     def setLinked(self, value):
         self._linkedBtn.setChecked(value!=0)
@@ -426,37 +1922,256 @@ class ImageWindow(QWidget):
 
 
     def saveTriggered(self):
-        dstFile = self.config.proposeFilename()
-        if dstFile == None: return
+        dstFile = self.config.proposeFilename(self.config.exportSettings.suffix())
+        if dstFile == None or self._exportThread != None: return
         print("saving in "+dstFile)
 
-        # create an image for the final output
-        img = QImage(self.config.saveSize, QImage.Format_RGB888)
-        qp = QPainter(img)
-
-        # black background and then the images
-        dst = QRect(0,0,img.width(), img.height())
-        brush = QBrush(Qt.SolidPattern)
-        brush.setColor(Qt.black)
-        qp.setBrush(brush)
-        qp.drawRect(dst)
-        self.config.paintImage(qp, dst)
-
-        qp.end()
-        img.save(dstFile)
+        # rendering and encoding happen in the background
+        self._exportThread = ExportThread(self.config, dstFile, self)
+        self._exportThread.progress.connect(self._progressBar.setValue)
+        self._exportThread.failed.connect(lambda e: print("saving failed: "+e))
+        self._exportThread.finished.connect(self.exportFinished)
+        self._saveBtn.setEnabled(False)
+        self._progressBar.setValue(0)
+        self._progressBar.setVisible(True)
+        self._exportThread.start()
+
+    def exportFinished(self):
+        self._exportThread = None
+        self._saveBtn.setEnabled(True)
+        self._progressBar.setVisible(False)
+
+
+class DepthEngine:
+    # computes 16 times the disparity of the left image as int16
+    name = None
+    # odd block sizes opencv accepts
+    minBlockSize = 1
+    maxBlockSize = 51
+
+    def __init__(self, numDisparities=16, blockSize=15):
+        self.numDisparities, self.blockSize = self.validSettings(
+            numDisparities, blockSize)
+
+    @classmethod
+    def validSettings(cls, numDisparities, blockSize):
+        # disparities are a positive multiple of 16, block sizes odd
+        numDisparities = max(16, int(numDisparities)//16*16)
+        blockSize = min(max(int(blockSize)|1, cls.minBlockSize), cls.maxBlockSize)
+        return numDisparities, blockSize
+
+    def matcher(self):
+        raise NotImplementedError
+
+    def overlap(self):
+        # rows a band needs beyond its border to match the full image result
+        return self.blockSize
+
+    def compute(self, left, right, out=None):
+        return self.matcher().compute(left, right, out)
+
+
+class BMDepthEngine(DepthEngine):
+    name = "BM"
+    minBlockSize = 5
+
+    def matcher(self):
+        return cv2.StereoBM.create(numDisparities=self.numDisparities,
+            blockSize=self.blockSize)
+
+
+class SGBMDepthEngine(DepthEngine):
+    name = "SGBM"
+
+    def __init__(self, numDisparities=64, blockSize=5):
+        super().__init__(numDisparities, blockSize)
+
+    def matcher(self):
+        return cv2.StereoSGBM.create(
+            minDisparity = 0,
+            numDisparities = self.numDisparities,
+            blockSize = self.blockSize,
+            uniquenessRatio = 10,
+            speckleWindowSize = 100,
+            speckleRange = 32,
+            disp12MaxDiff = 1,
+            P1 = 8*self.blockSize**2,
+            P2 = 32*self.blockSize**2,
+            mode = cv2.StereoSGBM_MODE_SGBM_3WAY)
+
+    def overlap(self):
+        # the path costs spread along the columns, add some margin
+        return 2*self.blockSize+16
+
+
+class WLSDepthEngine(SGBMDepthEngine):
+    # https://docs.opencv.org/3.1.0/d3/d14/tutorial_ximgproc_disparity_filtering.html
+    name = "SGBM+WLS"
+
+    @staticmethod
+    def available():
+        # the filter is part of opencv-contrib
+        return hasattr(cv2, "ximgproc")
+
+    def overlap(self):
+        return super().overlap()+32
+
+    def compute(self, left, right, out=None):
+        leftMatcher = self.matcher()
+        rightMatcher = cv2.ximgproc.createRightMatcher(leftMatcher)
+        wls = cv2.ximgproc.createDisparityWLSFilter(leftMatcher)
+        wls.setLambda(8000.0)
+        wls.setSigmaColor(1.5)
+        return wls.filter(leftMatcher.compute(left, right), left, out,
+            rightMatcher.compute(right, left))
+
+
+def depthEngines():
+    engines = [BMDepthEngine, SGBMDepthEngine]
+    if WLSDepthEngine.available(): engines.append(WLSDepthEngine)
+    return engines
+
+
+class DepthSettings(namedtuple("DepthSettings",
+        "engine numDisparities blockSize tiled")):
+    def __new__(cls, engine="BM", numDisparities=16, blockSize=15, tiled=False):
+        return super().__new__(cls, engine, numDisparities, blockSize, tiled)
+
+    def create(self):
+        # unknown or unavailable engines fall back to block matching, values
+        # from project files the engine cannot use are clamped
+        engines = dict((e.name, e) for e in depthEngines())
+        return engines.get(self.engine, BMDepthEngine)(self.numDisparities,
+            self.blockSize)
+
+
+class DisparityStats(namedtuple("DisparityStats", "parallax vertical cells")):
+    # shifts of the right eye against the left one in the cells of a grid,
+    # in view widths. Positive parallax lies behind the screen, negative
+    # parallax in front of it.
+
+    # comfort limits in view widths
+    maxRange = 1/30
+    maxNear = -0.02
+    maxFar = 0.03
+    maxVertical = 0.002
+    # minimal share of cells that could be measured
+    minCoverage = 0.1
+
+    def percentile(self, q):
+        if len(self.parallax) == 0: return 0.0
+        return float(np.percentile(self.parallax, q))
+
+    def near(self): return self.percentile(2)
+    def far(self): return self.percentile(98)
+    def median(self): return self.percentile(50)
+
+    def verticalError(self):
+        if len(self.vertical) == 0: return 0.0
+        return float(np.median(self.vertical))
+
+    def coverage(self):
+        return len(self.parallax)/self.cells if self.cells else 0.0
+
+    def histogram(self, bins=40, limit=0.05):
+        counts, edges = np.histogram(np.clip(self.parallax, -limit, limit),
+            bins, (-limit, limit))
+        return counts, edges
+
+    def shifted(self, parallax, vertical):
+        # after moving the images instead of measuring again
+        return self._replace(parallax=self.parallax+parallax,
+            vertical=self.vertical+vertical)
+
+    def warnings(self):
+        if self.coverage() < self.minCoverage:
+            return ["Zu wenig Struktur für eine Messung"]
+        warnings = []
+        if self.far()-self.near() > self.maxRange:
+            warnings.append("Tiefenbereich zu groß")
+        if self.near() < self.maxNear:
+            warnings.append("Vordergrund zu weit vor dem Bildschirm")
+        if self.far() > self.maxFar:
+            warnings.append("Hintergrund zu weit hinten (Divergenz)")
+        if abs(self.verticalError()) > self.maxVertical:
+            warnings.append("Vertikaler Versatz")
+        return warnings
+
+
+def disparityStats(left, right, cellSize=64, maxGrid=12, minResponse=0.1):
+    # phase correlation of the gray eyes cell by cell, a cell finds shifts
+    # up to half its size. Flat cells like the black borders are skipped.
+    h, w = left.shape
+    grid = max(1, min(maxGrid, w//cellSize, h//cellSize))
+    ch = h//grid
+    cw = w//grid
+    window = cv2.createHanningWindow((cw, ch), cv2.CV_32F)
+    parallax = []
+    vertical = []
+    for y in range(0, grid*ch, ch):
+        for x in range(0, grid*cw, cw):
+            l = np.float32(left[y:y+ch, x:x+cw])
+            r = np.float32(right[y:y+ch, x:x+cw])
+            if l.std() < 4 or r.std() < 4: continue
+            (dx, dy), response = cv2.phaseCorrelate(l, r, window)
+            if response < minResponse: continue
+            parallax.append(dx/w)
+            vertical.append(dy/w)
+    return DisparityStats(np.float32(parallax), np.float32(vertical), grid*grid)
+
+
+def viewGeometry(snapshot):
+    # the levels, rotation and linear part of a snapshot decide the
+    # picture, the translation only moves it
+    t = snapshot.transform
+    return (snapshot.levels, snapshot.rotation,
+        (t.m11(), t.m12(), t.m21(), t.m22()), t.dx(), t.dy())
+
+
+def sameGeometry(a, b):
+    return a[0] is b[0] and a[1:3] == b[1:3]
+
+
+class DepthBuffers:
+    # images and arrays reused by every depth map computation of one size
+    def __init__(self, size):
+        self.left = QImage(size, QImage.Format_Grayscale8)
+        self.right = QImage(size, QImage.Format_Grayscale8)
+        self.disparity = np.empty((size.height(), size.width()), np.int16)
+        self.work = np.empty((size.height(), size.width()), np.int32)
+        # the view paints one output while the other one is written
+        self.outputs = [QImage(size, QImage.Format_Grayscale8) for i in range(2)]
+        for img in self.outputs: img.fill(Qt.black)
 
 
 class DepthRenderThread(QThread):
     renderedImage = pyqtSignal()
+    statsChanged = pyqtSignal()
+    # while the images change, depth maps are computed on images scaled
+    # down by draftScale, the full resolution follows after refineDelay ms
+    draftScale = 4
+    refineDelay = 300
+
     def __init__(self, w,h, l,r, parent=None):
         super(DepthRenderThread, self).__init__(parent)
         self.mutex = QMutex()
         self.condition = QWaitCondition()
         self.left = l
         self.right = r
-        self.image = QImage(w, h, QImage.Format_Grayscale8)
+        self.size = QSize(w, h)
+        self.buffers = {}
+        self.image = self._buffers(self.size).outputs[0]
+        self.request = 0
+        self.lastChange = 0
         self.restart = False
         self.abort = False
+        self.engine = BMDepthEngine()
+        self.tiled = False
+        self.pool = ThreadPoolExecutor(os.cpu_count())
+        # disparity statistics of the latest images and the measurement
+        # they were derived from
+        self.stats = None
+        self._statsBase = None
 
     def __del__(self):
         self.mutex.lock()
@@ -467,97 +2182,200 @@ class DepthRenderThread(QThread):
 
     def updateImage(self):
         locker = QMutexLocker(self.mutex)
+        # pending requests collapse into the latest one
+        self.request += 1
+        self.lastChange = time.monotonic()
+        metrics.count("depth.requests")
         if not self.isRunning():
             self.start(QThread.LowPriority)
         else:
+            if self.restart: metrics.count("depth.coalesced")
             self.restart = True
             self.condition.wakeOne()
 
-    def _updateImage(self):
-        print("updating depth map")
+    def setEngine(self, engine, tiled):
+        self.mutex.lock()
+        self.engine = engine
+        self.tiled = tiled
+        self.mutex.unlock()
+        self.updateImage()
 
-        tmp = self.image.copy()
-        tmp.fill(Qt.black)
-        qp = QPainter(tmp)
-        self.left.paintImage(qp, QRect(QPoint(0,0), tmp.size()))
-        qp.end()
-        ptr = tmp.constBits()
-        ptr.setsize(tmp.byteCount())
-        left = np.array(ptr).reshape( tmp.height(), tmp.width(), 1)
+    # final depth maps are looked up in the disk cache
+    useCache = True
 
-        qp = QPainter(tmp)
-        self.right.paintImage(qp, QRect(QPoint(0,0), tmp.size()))
+    def stale(self, request):
+        # the images changed again since the computation started
+        return self.abort or self.request != request
+
+    def _buffers(self, size):
+        key = (size.width(), size.height())
+        if key not in self.buffers: self.buffers[key] = DepthBuffers(size)
+        return self.buffers[key]
+
+    def _paintGray(self, state, img):
+        img.fill(Qt.black)
+        qp = QPainter(img)
+        state.paintImage(qp, QRect(QPoint(0,0), img.size()))
         qp.end()
-        ptr = tmp.constBits()
-        ptr.setsize(tmp.byteCount())
-        right = np.array(ptr).reshape( tmp.height(), tmp.width(), 1)
-
-        print("begin detection...")
-
-        stereo = cv2.StereoBM.create(numDisparities=16, blockSize=15)
-
-        # window_size = 3
-        # min_disp = 16
-        # num_disp = 112-min_disp
-        # stereo = cv2.StereoSGBM.create(
-        #     minDisparity = min_disp,
-        #     numDisparities = num_disp,
-        #     blockSize = window_size,
-        #     uniquenessRatio = 10,
-        #     speckleWindowSize = 100,
-        #     speckleRange = 32,
-        #     disp12MaxDiff = 1,
-        #     P1 = 8*3*window_size**2,
-        #     P2 = 32*3*window_size**2
-        #     )
-
-        #im = right
-        im = stereo.compute(left, right)
-        #pprint(im)
-        im = (im/16).astype(np.uint8)
-        print("convert result to QImage")
+        return imageArray(img)
 
-        # consider post processing: https://docs.opencv.org/3.1.0/d3/d14/tutorial_ximgproc_disparity_filtering.html
+    def _updateImage(self, request, draft):
+        print("updating depth map"+(" (draft)" if draft else ""))
+        scale = self.draftScale if draft else 1
+        size = QSize(self.size.width()//scale, self.size.height()//scale)
 
         self.mutex.lock()
-        self.image = QImage(im.data, im.shape[1], im.shape[0], im.strides[0],
-            QImage.Format_Grayscale8).copy()
+        engine = self.engine
+        tiled = self.tiled
         self.mutex.unlock()
-        print("3d final image size "+str(self.image.width())+"x"+str(self.image.height()))
+        # a newer state makes the request stale, so both fit together
+        snapshots = (self.left.snapshot(), self.right.snapshot())
+
+        buffers = self._buffers(size)
+        out = buffers.outputs[1] if self.image is buffers.outputs[0] else buffers.outputs[0]
+        left = self._paintGray(snapshots[0], buffers.left)
+        if self.stale(request): return False
+        right = self._paintGray(snapshots[1], buffers.right)
+        if self.stale(request): return False
+        self._updateStats(snapshots, left, right, draft)
+        if self.stale(request): return False
+
+        # final depth maps of completely loaded images are cached on disk
+        key = None
+        if self.useCache and not draft and all(s.contentHash for s in snapshots):
+            key = DiskCache.key("depth",
+                [(s.contentHash, s.rotation, transformToList(s.transform))
+                    for s in snapshots],
+                engine.name, engine.numDisparities, engine.blockSize, tiled,
+                size.width(), size.height())
+            data = depthCache().get(key)
+            if data != None:
+                print("depth map from cache")
+                metrics.count("depth.cached")
+                np.copyto(imageArray(out, True), data["depth"])
+                self._swapOutput(out)
+                return True
+
+        print("begin detection with "+engine.name+(" (tiled)" if tiled else ""))
+        im = buffers.disparity
+        if tiled:
+            if not self._computeTiled(engine, left, right, im, request):
+                return False
+        else:
+            engine.compute(left, right, im)
+        if self.stale(request): return False
+
+        # spread the disparity range over the gray values, draft disparities
+        # are in units of the smaller image
+        print("convert result to QImage")
+        maxDisparity = 16*engine.numDisparities
+        np.clip(im, 0, maxDisparity//scale, out=im)
+        np.multiply(im, 255*scale, out=buffers.work)
+        np.floor_divide(buffers.work, maxDisparity, out=buffers.work)
+        np.copyto(imageArray(out, True), buffers.work, casting='unsafe')
+        if key != None: depthCache().put(key, True, depth=imageArray(out))
+
+        self._swapOutput(out)
+        print("3d final image size "+str(out.width())+"x"+str(out.height()))
+        return True
+
+    def _updateStats(self, snapshots, left, right, draft):
+        # while the images are only moved, all disparities move by the same
+        # amount and the last measurement is shifted, the final pass
+        # always measures again
+        geometry = [viewGeometry(s) for s in snapshots]
+        base = self._statsBase
+        if draft and base != None and all(sameGeometry(g, b)
+                for g, b in zip(geometry, base[1])):
+            (l, r), (l0, r0) = geometry, base[1]
+            stats = base[0].shifted((r[3]-r0[3])-(l[3]-l0[3]),
+                (r[4]-r0[4])-(l[4]-l0[4]))
+        else:
+            with metrics.timed("depth.stats"):
+                stats = disparityStats(left, right)
+            self._statsBase = (stats, geometry)
+        self.mutex.lock()
+        self.stats = stats
+        self.mutex.unlock()
+        self.statsChanged.emit()
+
+    def _swapOutput(self, out):
+        self.mutex.lock()
+        self.image = out
+        self.mutex.unlock()
+
+    def _computeTiled(self, engine, left, right, im, request):
+        # overlapping horizontal bands on all cores, opencv releases the gil
+        h = left.shape[0]
+        bands = min(os.cpu_count(), max(1, h//64))
+        border = engine.overlap()
+        rows = [(h*i//bands, h*(i+1)//bands) for i in range(bands)]
+        futures = []
+        for top, bottom in rows:
+            t = max(0, top-border)
+            b = min(h, bottom+border)
+            futures.append(self.pool.submit(engine.compute, left[t:b], right[t:b]))
+
+        for (top, bottom), future in zip(rows, futures):
+            if self.stale(request):
+                for f in futures: f.cancel()
+                return False
+            t = max(0, top-border)
+            im[top:bottom] = future.result()[top-t:bottom-t]
+        return True
 
 
     def run(self):
         while not self.abort:
-            self._updateImage()
-            self.renderedImage.emit()
-
             self.mutex.lock()
-            if not self.restart:
-                self.condition.wait(self.mutex)
+            request = self.request
+            draft = time.monotonic()-self.lastChange < self.refineDelay/1000
             self.restart = False
             self.mutex.unlock()
 
+            start = time.perf_counter()
+            try:
+                done = self._updateImage(request, draft)
+            except cv2.error as e:
+                # a bad engine parameter must not end the application,
+                # wait for the next change instead
+                print("depth map failed: "+str(e))
+                done = None
+            if done:
+                metrics.record("depth.draft" if draft else "depth",
+                    time.perf_counter()-start)
+                self.renderedImage.emit()
+            elif done == False:
+                metrics.count("depth.dropped")
 
-class DepthWindow(QWidget):
-    def __init__(self, config, parent=None):
+            self.mutex.lock()
+            if not self.restart and not self.abort and done != False:
+                if draft:
+                    # refine once the images were left alone for a while
+                    self.condition.wait(self.mutex, self.refineDelay)
+                else:
+                    self.condition.wait(self.mutex)
+            self.mutex.unlock()
+
+
+class DepthView(QWidget):
+    def __init__(self, config, thread, parent=None):
         super().__init__(parent)
         self.config = config
-        self.setWindowTitle('3D Tiefenkarte')
+        self.thread = thread
 
         self.setMinimumSize(self.config.aspectRatio.width()*5/2,
             self.config.aspectRatio.height()*5)
         self.setMaximumSize(self.config.aspectRatio.width()*50/2,
             self.config.aspectRatio.height()*50)
-
-        aw = self.config.aspectRatio.width()
-        ah = self.config.aspectRatio.height()
-        self.thread = DepthRenderThread(aw*200/2, ah*200,
-            self.config.leftState(), self.config.rightState(), self)
+        self.showStats = True
         self.thread.renderedImage.connect(self.repaint)
+        self.thread.statsChanged.connect(self.update)
+        self.config.metricsUpdated.connect(self.update)
 
-        self.config.leftState().changed.connect(self.thread.updateImage)
-        self.config.rightState().changed.connect(self.thread.updateImage)
-
+    def setShowStats(self, show):
+        self.showStats = bool(show)
+        self.update()
 
     def sizeHint(self):
         return QSize(self.config.aspectRatio.width()*39/2,
@@ -576,6 +2394,7 @@ class DepthWindow(QWidget):
         return QRect((self.width()-w)/2,(self.height()-h)/2,w,h)
 
     def paintEvent(self, event):
+        start = time.perf_counter()
         locker = QMutexLocker(self.thread.mutex)
         img = self.thread.image
 
@@ -612,16 +2431,680 @@ class DepthWindow(QWidget):
         qp.drawLine(dst.x()+0,dst.y()+dst.height()*2/3,
             dst.x()+dst.width(),dst.y()+dst.height()*2/3)
 
+        stats = self.thread.stats
+        locker.unlock()
+        if self.showStats and stats != None:
+            self.paintStats(qp, dst, stats)
+        if self.config.showMetrics:
+            paintMetrics(qp, dst, metrics.summary(("depth",)))
         qp.end()
+        metrics.record("paint.depth", time.perf_counter()-start)
 
+    def paintStats(self, qp, dst, stats, limit=0.05):
+        # histogram of the parallax along the bottom with the comfortable
+        # range in green and the screen plane as white line
+        qp.save()
+        h = dst.height()/6
+        box = QRectF(dst.x(), dst.y()+dst.height()-h, dst.width(), h)
+        def xpos(p): return box.x()+(p+limit)/(2*limit)*box.width()
+        qp.fillRect(box, QColor(0,0,0,160))
+        qp.fillRect(QRectF(QPointF(xpos(DisparityStats.maxNear), box.y()),
+            QPointF(xpos(DisparityStats.maxFar), box.bottom())),
+            QColor(0,160,0,60))
+        counts, edges = stats.histogram(limit=limit)
+        if counts.max() > 0:
+            qp.setPen(Qt.NoPen)
+            qp.setBrush(QColor(255,255,255,180))
+            for count, x0, x1 in zip(counts, edges[:-1], edges[1:]):
+                bar = count/counts.max()*(box.height()-4)
+                qp.drawRect(QRectF(xpos(x0), box.bottom()-bar,
+                    xpos(x1)-xpos(x0)-1, bar))
+        qp.setPen(QColor(255,255,255))
+        qp.drawLine(QPointF(xpos(0), box.y()), QPointF(xpos(0), box.bottom()))
+
+        lines = ["Parallaxe %+.1f%% .. %+.1f%%" % (100*stats.near(), 100*stats.far()),
+            "Median %+.1f%%  vertikal %+.2f%%" % (100*stats.median(),
+                100*stats.verticalError()),
+            "Abdeckung %d%%" % (100*stats.coverage())]
+        warnings = stats.warnings()
+        font = QFontDatabase.systemFont(QFontDatabase.FixedFont)
+        qp.setFont(font)
+        fm = qp.fontMetrics()
+        y = box.y()-4-fm.descent()-fm.height()*(len(lines)+len(warnings)-1)
+        for i, line in enumerate(lines+warnings):
+            qp.setPen(QColor(255,255,255) if i < len(lines) else QColor(255,160,0))
+            qp.drawText(QPointF(box.x()+4, y+i*fm.height()), line)
+        qp.restore()
 
-if __name__ == '__main__':
 
-    app = QApplication(sys.argv)
+class DepthWindow(QWidget):
+    def __init__(self, config, parent=None):
+        super().__init__(parent)
+        self.config = config
+        self.setWindowTitle('3D Tiefenkarte')
+
+        aw = self.config.aspectRatio.width()
+        ah = self.config.aspectRatio.height()
+        self.thread = DepthRenderThread(aw*200/2, ah*200,
+            self.config.leftState(), self.config.rightState(), self)
+
+        self.config.leftState().changed.connect(self.thread.updateImage)
+        self.config.rightState().changed.connect(self.thread.updateImage)
+
+        # depth engine settings
+        self._engineBox = QComboBox(self)
+        for engine in depthEngines():
+            self._engineBox.addItem(engine.name, engine.name)
+        self._disparitiesBox = QSpinBox(self)
+        self._disparitiesBox.setRange(16, 256)
+        self._disparitiesBox.setSingleStep(16)
+        self._blockSizeBox = QSpinBox(self)
+        self._blockSizeBox.setRange(DepthEngine.minBlockSize,
+            DepthEngine.maxBlockSize)
+        self._blockSizeBox.setSingleStep(2)
+        self._tiledBtn = QCheckBox("gekachelt", self)
+        self._metricsBtn = QCheckBox("Messwerte", self)
+        self._metricsBtn.setChecked(self.config.showMetrics)
+        self._metricsBtn.stateChanged.connect(self.config.setShowMetrics)
+        self.config.showMetricsChanged.connect(self._metricsBtn.setChecked)
+        self.setDepthSettings()
+        self.config.depthSettingsChanged.connect(self.setDepthSettings)
+
+        # disparity statistics and the zero parallax plane
+        self._statsBtn = QCheckBox("Statistik", self)
+        self._statsBtn.setChecked(True)
+        self._convergeBox = QSpinBox(self)
+        self._convergeBox.setRange(0, 100)
+        self._convergeBox.setValue(10)
+        self._convergeBox.setSuffix(" %")
+        self._convergeBox.setToolTip("Anteil der Bildpunkte vor dem Bildschirm")
+        self._convergeBtn = QPushButton("Auto-Konvergenz", self)
+        self._convergeBtn.clicked.connect(self.autoConverge)
+
+        self._engineBox.currentIndexChanged.connect(self.setEngineType)
+        self._disparitiesBox.valueChanged.connect(self.engineChanged)
+        self._blockSizeBox.valueChanged.connect(self.engineChanged)
+        self._tiledBtn.stateChanged.connect(self.engineChanged)
+
+        tb = QHBoxLayout()
+        tb.addWidget(self._engineBox)
+        tb.addWidget(QLabel("Disparitäten", self))
+        tb.addWidget(self._disparitiesBox)
+        tb.addWidget(QLabel("Blockgröße", self))
+        tb.addWidget(self._blockSizeBox)
+        tb.addWidget(self._tiledBtn)
+        tb.addStretch(1)
+        tb.addWidget(QLabel("Nullebene", self))
+        tb.addWidget(self._convergeBox)
+        tb.addWidget(self._convergeBtn)
+        tb.addWidget(self._statsBtn)
+        tb.addWidget(self._metricsBtn)
+
+        vbox = QVBoxLayout()
+        vbox.addLayout(tb)
+        self.view = DepthView(self.config, self.thread, self)
+        self._statsBtn.stateChanged.connect(self.view.setShowStats)
+        vbox.addWidget(self.view, 1)
+        self.setLayout(vbox)
+
+    def sizeHint(self):
+        return QSize(self.config.aspectRatio.width()*39/2,
+            self.config.aspectRatio.height()*30)
+
+    def setDepthSettings(self):
+        settings = self.config.depthSettings
+        engine = settings.create()
+        widgets = (self._engineBox, self._disparitiesBox, self._blockSizeBox,
+            self._tiledBtn)
+        for w in widgets: w.blockSignals(True)
+        self._engineBox.setCurrentIndex(self._engineBox.findData(engine.name))
+        self._blockSizeBox.setRange(engine.minBlockSize, engine.maxBlockSize)
+        self._disparitiesBox.setValue(engine.numDisparities)
+        self._blockSizeBox.setValue(engine.blockSize)
+        self._tiledBtn.setChecked(settings.tiled)
+        for w in widgets: w.blockSignals(False)
+        self.thread.setEngine(engine, settings.tiled)
+
+    def setEngineType(self, index):
+        # start from the defaults of the selected engine
+        name = self._engineBox.itemData(index)
+        engine = dict((e.name, e) for e in depthEngines())[name]()
+        self.config.depthSettings = DepthSettings(name, engine.numDisparities,
+            engine.blockSize, self._tiledBtn.isChecked())
+
+    def autoConverge(self):
+        # moves the right image so that the chosen share of the scene lies
+        # in front of the screen plane
+        self.thread.mutex.lock()
+        stats = self.thread.stats
+        self.thread.mutex.unlock()
+        if stats == None or len(stats.parallax) == 0: return
+        p = stats.percentile(self._convergeBox.value())
+        right = self.config.rightState()
+        right.transform = right.transform*QTransform.fromTranslate(-p, 0)
+
+    def engineChanged(self):
+        # block sizes have to be odd and disparities a multiple of 16
+        self.config.depthSettings = DepthSettings(self._engineBox.currentData(),
+            self._disparitiesBox.value()//16*16, self._blockSizeBox.value()|1,
+            self._tiledBtn.isChecked())
+
+
+def projectPath(leftFile, rightFile):
+    # the project of a pair lives next to the left image
+    pl = Path(leftFile)
+    pr = Path(rightFile)
+    return pl.parent.joinpath(pl.stem+"-"+pr.stem+ProjectFile.suffix)
+
+
+def readProject(path):
+    path = Path(path)
+    project = json.loads(path.read_text())
+    for side in ("left", "right"):
+        project[side]["file"] = str(path.parent.joinpath(project[side]["file"]))
+    return project
+
+
+def projectJob(path):
+    # batch job that re-renders a saved project
+    project = readProject(path)
+    job = {}
+    for side in ("left", "right"):
+        job[side] = project[side]["file"]
+        job[side+"Rotation"] = project[side]["rotation"]
+        job[side+"Transform"] = project[side]["transform"]
+    return job
+
+
+class ProjectFile(QObject):
+    # remembers the alignment of a pair in a sidecar file that is saved
+    # automatically and restored when the same images are opened again
+    suffix = ".3dmacher.json"
+    saveDelay = 1000
+
+    def __init__(self, config, parent=None):
+        super().__init__(parent)
+        self.config = config
+        # load ids of the pair the current project belongs to
+        self._pair = None
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(self.saveDelay)
+        self._timer.timeout.connect(self.save)
+        self.config.leftState().changed.connect(self.stateChanged)
+        self.config.rightState().changed.connect(self.stateChanged)
+        self.config.depthSettingsChanged.connect(self.stateChanged)
+        self.config.exportSettingsChanged.connect(self.stateChanged)
+
+    def states(self):
+        return (self.config.leftState(), self.config.rightState())
+
+    def ready(self):
+        # both images are completely loaded
+        return all(s.image != None and not s.loading for s in self.states())
+
+    def path(self):
+        return projectPath(*(s.sourceFile for s in self.states()))
+
+    def stateChanged(self):
+        if not self.ready(): return
+        pair = tuple(s._loadId for s in self.states())
+        if self._pair != pair:
+            # a new pair, the project has to be restored before saving
+            self._pair = pair
+            self._timer.stop()
+            self.restore()
+        else:
+            self._timer.start()
+
+    def restore(self):
+        path = self.path()
+        if not path.exists(): return
+        try:
+            project = readProject(path)
+        except (OSError, ValueError, KeyError) as e:
+            print("cannot read project "+str(path)+": "+str(e))
+            return
+        # only if the files still have the same content
+        for state, side in zip(self.states(), ("left", "right")):
+            if project[side]["sha1"] != state.contentHash:
+                print("project "+str(path)+" belongs to other images")
+                return
+        print("restoring project "+str(path))
+        for state, side in zip(self.states(), ("left", "right")):
+            state.setGeometry(project[side]["rotation"],
+                transformFromList(project[side]["transform"]))
+        if "depth" in project:
+            self.config.depthSettings = DepthSettings(**project["depth"])
+        if "export" in project:
+            self.config.exportSettings = ExportSettings(**project["export"])
+
+    def save(self):
+        if not self.ready(): return
+        path = self.path()
+        project = {"format": "3dmacher", "version": 1}
+        for state, side in zip(self.states(), ("left", "right")):
+            project[side] = {
+                "file": os.path.relpath(state.sourceFile, path.parent),
+                "sha1": state.contentHash,
+                "rotation": state.rotation,
+                "transform": transformToList(state.transform)}
+        project["depth"] = self.config.depthSettings._asdict()
+        project["export"] = self.config.exportSettings._asdict()
+        # replace the old file only when the new one is complete
+        tmp = path.with_name(path.name+".tmp")
+        try:
+            tmp.write_text(json.dumps(project, indent=2))
+            os.replace(tmp, path)
+        except OSError as e:
+            print("cannot save project "+str(path)+": "+str(e))
+
+
+def batchJobs(path, output=None, suffix=".jpg"):
+    # a directory re-renders its projects and pairs the remaining images in
+    # name order (1+2, 3+4, ...). A json manifest lists {"left", "right",
+    # "output", "leftTransform", "rightTransform", "leftRotation",
+    # "rightRotation"} per pair.
+    path = Path(path)
+    if path.name.endswith(ProjectFile.suffix):
+        jobs = [projectJob(path)]
+    elif path.is_dir():
+        jobs = [projectJob(p) for p in sorted(path.glob("*"+ProjectFile.suffix))]
+        used = set(Path(job[side]).resolve() for job in jobs
+            for side in ("left", "right"))
+        files = [f for f in imageFiles([path]) if Path(f).resolve() not in used]
+        jobs += [{"left": str(l), "right": str(r)}
+            for l, r in zip(files[0::2], files[1::2])]
+        if len(files) % 2:
+            print("skipping "+files[-1]+", it has no partner")
+        if output == None: output = path.joinpath("3d")
+    else:
+        jobs = json.loads(path.read_text())
+        for job in jobs:
+            for key in ("left", "right", "output"):
+                if key in job: job[key] = str(path.parent.joinpath(job[key]))
+
+    for job in jobs:
+        if output != None and "output" not in job:
+            l = Path(job["left"])
+            r = Path(job["right"])
+            job["output"] = str(Path(output).joinpath(l.stem+"-"+r.stem+suffix))
+    return jobs
+
+
+def _batchInit():
+    # every worker process needs its own (windowless) Qt instance
+    global _batchApp
+    _batchApp = QGuiApplication(["3dmacher", "-platform", "offscreen"])
+
+
+def composePair(job):
+    start = time.monotonic()
+    config = GlobalConfig()
+    config.renderer = job.get("renderer", config.renderer)
+    config.interpolation = job.get("interpolation", config.interpolation)
+    for state, side in ((config.leftState(), "left"), (config.rightState(), "right")):
+        state.loadFile(job[side])
+        if state.image == None:
+            return (job, None, "cannot read "+job[side])
+        for i in range(job.get(side+"Rotation", 0)):
+            state.rotate90()
+        if side+"Transform" in job:
+            state.transform = transformFromList(job[side+"Transform"])
+
+    settings = ExportSettings(*job.get("export", []))
+    dstFile = job.get("output") or config.proposeFilename(settings.suffix())
+    Path(dstFile).parent.mkdir(parents=True, exist_ok=True)
+    snapshot = config.snapshot()
+    try:
+        exportSnapshot(snapshot, settings,
+            settings.size(snapshot, config.aspectRatio), dstFile)
+    except (IOError, cv2.error) as e:
+        return (job, None, "cannot write "+dstFile+": "+str(e))
+    return (job, dstFile, time.monotonic()-start)
+
+
+def runBatch(args):
+    # every pair once per layout
+    jobs = []
+    for layout in args.layout:
+        settings = exportSettingsFromArgs(args)._replace(layout=layout)
+        for job in batchJobs(args.batch, args.output, settings.suffix()):
+            job.setdefault("renderer", args.renderer)
+            job.setdefault("interpolation", args.interpolation)
+            job.setdefault("export", list(settings))
+            jobs.append(job)
+    processes = max(1, min(args.jobs, len(jobs)))
+    print("composing %d pairs with %d processes" % (len(jobs), processes))
+    start = time.monotonic()
+    done = 0
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(processes, initializer=_batchInit) as pool:
+        for job, dstFile, result in pool.imap_unordered(composePair, jobs):
+            if dstFile == None:
+                print("failed: "+result)
+                continue
+            done += 1
+            print("saved %s (%.2fs)" % (dstFile, result))
+    elapsed = time.monotonic()-start
+    print("%d of %d pairs in %.1fs, %.2f pairs/s" % (done, len(jobs),
+        elapsed, done/elapsed if elapsed > 0 else 0))
+    return 0 if done == len(jobs) else 1
+
+
+def videoPairs(leftFile, rightFile):
+    # frames of two synchronized clips until the shorter one ends, image
+    # sequences like burst/left_%04d.jpg work as well
+    captures = [cv2.VideoCapture(f) for f in (leftFile, rightFile)]
+    try:
+        for capture, f in zip(captures, (leftFile, rightFile)):
+            if not capture.isOpened(): raise IOError("cannot read "+f)
+        while True:
+            with metrics.timed("video.decode"):
+                frames = [capture.read() for capture in captures]
+            if not all(ok for ok, frame in frames): return
+            yield tuple(frame for ok, frame in frames)
+    finally:
+        for capture in captures: capture.release()
+
+
+def frameSnapshot(frame, rotation, transform):
+    # a QImage header over the first frame, only its size is used
+    img = QImage(frame.data, frame.shape[1], frame.shape[0], frame.strides[0],
+        QImage.Format_RGB888)
+    return ImageSnapshot(None, [img], rotation, transform, "")
+
+
+def composeFrame(left, right, matrices, size, interpolation):
+    out = np.zeros((size.height(), size.width(), 3), np.uint8)
+    w = size.width()//2
+    with metrics.timed("video.warp"):
+        for frame, matrix, half in zip((left, right), matrices,
+                (out[:, :w], out[:, w:])):
+            cv2.warpAffine(frame, matrix, (w, size.height()), half,
+                interpolation, cv2.BORDER_TRANSPARENT)
+    return out
+
+
+def composeVideo(job, settings, aspectRatio, progress=None):
+    # decoding runs on its own thread, warping on a pool and encoding on
+    # the calling thread, connected by bounded queues so that memory use
+    # does not depend on the length of the clip
+    pairs = videoPairs(job["left"], job["right"])
+    first = next(pairs, None)
+    if first == None: raise IOError("no frames in "+job["left"])
+
+    snapshot = StereoSnapshot(0,
+        frameSnapshot(first[0], job.get("leftRotation", 0),
+            transformFromList(job.get("leftTransform", transformToList(QTransform())))),
+        frameSnapshot(first[1], job.get("rightRotation", 0),
+            transformFromList(job.get("rightTransform", transformToList(QTransform())))),
+        "opencv", job.get("interpolation", "linear"))
+    size = settings.size(snapshot, aspectRatio)
+    # the same warp for every frame
+    half = QRect(0, 0, size.width()//2, size.height())
+    matrices = [imageAffine(s.image, s.transform, half, s.rotation)
+        for s in (snapshot.left, snapshot.right)]
+    interpolation = GlobalConfig.interpolationFlag(snapshot.interpolation)
+
+    capture = cv2.VideoCapture(job["left"])
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25
+    total = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    capture.release()
+    fourcc = "MJPG" if job["output"].lower().endswith(".avi") else "mp4v"
+    writer = cv2.VideoWriter(job["output"], cv2.VideoWriter_fourcc(*fourcc),
+        fps, (size.width(), size.height()))
+    if not writer.isOpened(): raise IOError("cannot write "+job["output"])
+
+    workers = os.cpu_count()
+    decoded = queue.Queue(2*workers)
+    def decode():
+        try:
+            decoded.put(first)
+            for pair in pairs: decoded.put(pair)
+        finally:
+            decoded.put(None)
+    decoder = threading.Thread(target=decode, daemon=True)
+    decoder.start()
+
+    frames = 0
+    pending = deque()
+    with ThreadPoolExecutor(workers) as pool:
+        def write(future):
+            nonlocal frames
+            frame = future.result()
+            with metrics.timed("video.encode"):
+                writer.write(frame)
+            frames += 1
+            if progress != None: progress(frames, total)
+        while True:
+            pair = decoded.get()
+            if pair == None: break
+            pending.append(pool.submit(composeFrame, pair[0], pair[1],
+                matrices, size, interpolation))
+            # frames are written in order, at most 2*workers are in flight
+            if len(pending) >= 2*workers: write(pending.popleft())
+        while pending: write(pending.popleft())
+    writer.release()
+    decoder.join()
+    return frames
+
+
+def runVideo(args):
+    _batchInit()
+    leftFile, rightFile = args.video
+    job = projectJob(args.project) if args.project else {}
+    job.update(left=leftFile, right=rightFile, interpolation=args.interpolation)
+    # without the frame number pattern of image sequences
+    l, r = (re.sub(r"[_-]?%\d*d", "", Path(f).stem) for f in args.video)
+    output = Path(args.output) if args.output else Path(leftFile).parent
+    output.mkdir(parents=True, exist_ok=True)
+    job["output"] = str(output.joinpath(l+"-"+r+".mp4"))
+
+    start = time.monotonic()
+    def progress(frames, total):
+        if frames % 25 == 0 or frames == total:
+            elapsed = time.monotonic()-start
+            print("%d/%d frames, %.1f fps" % (frames, total, frames/elapsed))
+    try:
+        frames = composeVideo(job, exportSettingsFromArgs(args),
+            GlobalConfig().aspectRatio, progress)
+    except (IOError, cv2.error) as e:
+        print("failed: "+str(e))
+        return 1
+    elapsed = time.monotonic()-start
+    print("saved %s, %d frames in %.1fs" % (job["output"], frames, elapsed))
+    return 0
+
+
+def syntheticPair(megapixels, directory):
+    # smooth random structures plus fine grain, the right image sees them
+    # shifted by 1% of the width like a scene at one depth
+    w = int(math.sqrt(megapixels*1e6*4/3))//16*16
+    h = w*3//4
+    rng = np.random.default_rng(megapixels)
+    coarse = rng.integers(0, 256, (h//32, w//32, 3), np.uint8)
+    img = cv2.resize(coarse, (w, h), interpolation=cv2.INTER_CUBIC)
+    img = cv2.add(img, rng.integers(0, 24, (h, w, 3), np.uint8))
+    paths = []
+    for name, shift in (("left", 0), ("right", w//100)):
+        path = os.path.join(directory, "%dmp-%s.jpg" % (megapixels, name))
+        cv2.imwrite(path, np.roll(img, -shift, axis=1), [cv2.IMWRITE_JPEG_QUALITY, 92])
+        paths.append(path)
+    return paths
+
+
+def timeRuns(fn, runs):
+    times = []
+    for i in range(runs):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter()-start)
+    return times
+
+
+def runBenchmark(args):
+    # times the hot paths on generated pairs, the json output can be
+    # compared between versions
+    _batchInit()
+    sizes = [int(mp) for mp in args.benchmark_sizes.split(",")]
+    results = []
+
+    def record(name, megapixels, times, **params):
+        entry = dict(name=name, megapixels=megapixels, runs=len(times),
+            min=min(times), median=statistics.median(times), **params)
+        print("%-8s %3d MP %-24s %8.1f ms" % (name, megapixels,
+            " ".join(str(v) for v in params.values()), entry["median"]*1000))
+        results.append(entry)
+
+    # progress goes to stderr, stdout may receive the json
+    with tempfile.TemporaryDirectory() as directory, \
+            contextlib.redirect_stdout(sys.stderr):
+        for megapixels in sizes:
+            files = syntheticPair(megapixels, directory)
+            config = GlobalConfig()
+
+            # decoding and building the proxies, as in ImageState.sourceFile
+            record("preview", megapixels, timeRuns(
+                lambda: buildLevels(readImage(files[0], ImageLoader.previewSize)),
+                args.benchmark_runs))
+            record("load", megapixels, timeRuns(
+                lambda: config.left.loadFile(files[0]), args.benchmark_runs))
+            config.right.loadFile(files[1])
+
+            # the viewer frame and full resolution export with every renderer
+            for renderer in GlobalConfig.renderers:
+                config.renderer = renderer
+                for fullQuality in (False, True):
+                    size = config.saveSize if not fullQuality else \
+                        ExportSettings("original").size(config.snapshot(), config.aspectRatio)
+                    record("compose", megapixels, timeRuns(
+                        lambda: config.renderImage(size, fullQuality),
+                        args.benchmark_runs), renderer=renderer,
+                        size="%dx%d" % (size.width(), size.height()))
+
+            # jpeg of the viewer frame, as sent by serveImage
+            frame = config.renderImage(config.saveSize)
+            def encode():
+                buffer = QBuffer()
+                buffer.open(QBuffer.ReadWrite)
+                frame.save(buffer, "JPG")
+            record("encode", megapixels, timeRuns(encode, args.benchmark_runs))
+
+            # a final depth map per engine, without the disk cache
+            aspect = config.aspectRatio
+            thread = DepthRenderThread(aspect.width()*100, aspect.height()*200,
+                config.left, config.right)
+            thread.useCache = False
+            for engine in depthEngines():
+                for tiled in (False, True):
+                    # set directly, setEngine would start the thread
+                    thread.engine = engine()
+                    thread.tiled = tiled
+                    record("depth", megapixels, timeRuns(
+                        lambda: thread._updateImage(thread.request, False),
+                        args.benchmark_runs), engine=engine.name, tiled=tiled)
+            thread.pool.shutdown()
+
+            for f in files: os.unlink(f)
+
+    report = dict(
+        python=platform.python_version(),
+        opencv=cv2.__version__,
+        qt=QT_VERSION_STR,
+        platform=platform.platform(),
+        cpus=os.cpu_count(),
+        results=results)
+    if args.benchmark == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        Path(args.benchmark).write_text(json.dumps(report, indent=2))
+    return 0
+
+
+def exportSettingsFromArgs(args):
+    return ExportSettings(args.preset, args.format, args.quality,
+        args.progressive, args.subsampling, args.layout[0])
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="3dmacher",
+        description="3D Bilder für Handy-VR-Brillen erstellen")
+    parser.add_argument("--batch", metavar="PATH",
+        help="compose all pairs of a directory or json manifest without a window")
+    parser.add_argument("--output", metavar="DIR",
+        help="output directory of the batch mode (default: DIR/3d for directories)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+        help="number of worker processes of the batch mode")
+    parser.add_argument("--renderer", choices=GlobalConfig.renderers,
+        default="opencv", help="compose the output with cv2.warpAffine or QPainter")
+    parser.add_argument("--interpolation", choices=list(GlobalConfig.interpolations),
+        default="nearest", help="pixel interpolation of the opencv renderer")
+    defaults = ExportSettings()
+    parser.add_argument("--preset", default=defaults.preset,
+        choices=[p[0] for p in ExportSettings.presets], help="output resolution")
+    parser.add_argument("--format", default=defaults.format,
+        choices=ExportSettings.formats, help="output file format")
+    parser.add_argument("--quality", type=int, default=defaults.quality,
+        help="jpeg and webp quality (1-100)")
+    parser.add_argument("--progressive", action="store_true",
+        help="write progressive jpegs")
+    parser.add_argument("--subsampling", default=defaults.subsampling,
+        choices=ExportSettings.subsamplings, help="jpeg chroma subsampling")
+    layouts = [l[0] for l in ExportSettings.layouts]
+    parser.add_argument("--layout", default=[defaults.layout],
+        type=lambda v: v.split(","), metavar="|".join(layouts),
+        help="arrangement of the eyes, the batch mode writes one file for "
+            "each of several comma separated layouts")
+    parser.add_argument("--video", nargs=2, metavar=("LEFT", "RIGHT"),
+        help="compose two synchronized clips or image sequences "
+            "(e.g. left_%%04d.jpg) into a side by side video")
+    parser.add_argument("--project", metavar="FILE",
+        help="use the alignment of a saved project for --video")
+    parser.add_argument("--burst", nargs="+", metavar="PATH",
+        help="open the best stereo pair of a burst shot while sliding sideways")
+    parser.add_argument("--benchmark", metavar="FILE", nargs="?", const="-",
+        help="time loading, composing, encoding and depth maps on generated "
+            "pairs and write the results as json (default: stdout)")
+    parser.add_argument("--benchmark-sizes", default="2,12,24,48",
+        help="comma separated megapixels of the generated pairs")
+    parser.add_argument("--benchmark-runs", type=int, default=3,
+        help="repetitions of every measurement")
+    parser.add_argument("--depth", action="store_true",
+        help="open the depth map window at start")
+    parser.add_argument("--server", action="store_true",
+        help="start the web server for the phone at start")
+    parser.add_argument("--port", type=int, default=ImageWindow.port,
+        help="first port tried by the web server, the following ones are "
+            "used when it is taken")
+    # remaining arguments are left to Qt
+    args, rest = parser.parse_known_args(argv[1:])
+
+    for layout in args.layout:
+        if layout not in layouts: parser.error("unknown layout "+layout)
+    if args.batch:
+        return runBatch(args)
+    if args.video:
+        return runVideo(args)
+    if args.benchmark:
+        return runBenchmark(args)
+
+    app = QApplication(argv[:1]+rest)
     config = GlobalConfig()
+    config.renderer = args.renderer
+    config.interpolation = args.interpolation
+    config.exportSettings = exportSettingsFromArgs(args)
     iw = ImageWindow(config)
+    iw.port = args.port
     iw.show()
-    dp = DepthWindow(config)
-    dp.show()
+    if args.server: iw.startServer()
+    if args.depth: iw.showDepth()
+    if args.burst:
+        config.loadBurst(imageFiles(args.burst))
 
-    sys.exit(app.exec_())
+    return app.exec_()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,73 @@
+# the opencv renderer has to give the same pixels as painting with qt
+
+import os
+import importlib.util
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5.QtCore import QSize
+from PyQt5.QtGui import QImage, QTransform
+from PyQt5.QtWidgets import QApplication
+
+spec = importlib.util.spec_from_file_location("dm",
+    Path(__file__).parent.parent.joinpath("3dmacher.py"))
+dm = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(dm)
+
+app = QApplication.instance() or QApplication([])
+
+
+def syntheticImage(w, h, seed):
+    # random colors per pixel, so every misplaced pixel shows
+    rng = np.random.default_rng(seed)
+    img = QImage(w, h, QImage.Format_RGB32)
+    a = dm.imageArray(img, True)
+    a[:] = rng.integers(0, 256, (h, w, 4), np.uint8)
+    return img
+
+
+# the left image fills an eye of the 800x450 output pixel for pixel
+left = syntheticImage(400, 300, 1)
+right = syntheticImage(300, 400, 2)
+
+
+def render(renderer, rotation, transform):
+    states = [dm.ImageSnapshot(None, [img], rotation, transform, "")
+        for img in (left, right)]
+    snapshot = dm.StereoSnapshot(0, states[0], states[1], renderer, "nearest")
+    img = snapshot.renderImage(QSize(800, 450), True)
+    return np.array(dm.imageArray(img.convertToFormat(QImage.Format_RGB32))[:,:,:3])
+
+
+def mismatch(rotation, transform):
+    qt = render("qt", rotation, transform)
+    cv = render("opencv", rotation, transform)
+    return np.any(qt != cv, axis=2).mean()
+
+
+# scales that put source pixel centers exactly between two output pixels,
+# like 1.5, are left out, qt and opencv round such ties differently
+axisAligned = {
+    "identity": QTransform(),
+    "scale": QTransform.fromScale(2, 2),
+    "shrink": QTransform.fromScale(0.5, 0.5),
+    "translate": QTransform.fromTranslate(0.1234, -0.0567),
+    "scale+translate": QTransform.fromScale(2, 2)*QTransform.fromTranslate(-0.2, 0.1),
+}
+
+
+@pytest.mark.parametrize("rotation", range(4))
+@pytest.mark.parametrize("name", axisAligned)
+def test_axis_aligned_identical(name, rotation):
+    assert mismatch(rotation, axisAligned[name]) == 0
+
+
+@pytest.mark.parametrize("rotation", range(4))
+@pytest.mark.parametrize("angle", [3, -10, 45])
+def test_rotated_close(angle, rotation):
+    transform = QTransform().rotate(angle)*QTransform.fromScale(1.1, 1.1)
+    assert mismatch(rotation, transform) < 0.01